@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+"""
+    bench_parse.py
+    times the CXF parser of text2laser.py against the original regex
+    cascade parser on every font in cxf_fonts/ and checks that both
+    build the same glyphs
+
+    usage: bench/bench_parse.py [repeat]
+"""
+
+import glob
+import os
+import re
+import sys
+import time
+from math import *
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+import text2laser
+
+
+# =======================================================================
+# The parser text2laser.py used before the tokenizer: every line goes
+# through the whole re.match cascade, the file is read line by line.
+# =======================================================================
+def regex_parse(filein):
+    font = {}
+    key = None
+    num_cmds = 0
+    xmax, ymax = 0, 0
+
+    for text in filein:
+        end_char = re.match('^$', text)  # blank line
+        if end_char and key:  # save the character to our dictionary
+            font[key] = text2laser.Character(key)
+            font[key].stroke_list_groups, font[key].stroke_list = text2laser.inside_first(stroke_list)
+            font[key].xmax = xmax
+
+        version_ = re.match('^# Version:\s+([\d\.]+)', text)
+        if version_:
+            version = version_.group(1)
+            if version.split('.')[0] != '1':
+                return None
+
+        new_cmd = re.match('^\[(.+?)\]\s+(\d+)', text)
+        if new_cmd:  # new character
+            key = new_cmd.group(1)
+            num_cmds = int(new_cmd.group(2))
+            cmds_read = 0
+            stroke_list = []
+            xmax, ymax = 0, 0
+
+        line_cmd = re.match('^L (.*)', text)
+        if line_cmd:
+            cmds_read += 1
+            coords = line_cmd.group(1)
+            coords = [float(n) for n in coords.split(',')]
+            stroke_list += [text2laser.Line(coords)]
+            xmax = max(xmax, coords[0], coords[2])
+            ymax = max(ymax, coords[1], coords[3])
+
+        arc_cmd = re.match('^A (.*)', text)
+        if arc_cmd:
+            cmds_read += 1
+            coords = arc_cmd.group(1)
+            coords = [float(n) for n in coords.split(',')]
+            xcenter, ycenter, radius, start_angle, end_angle = coords
+            if (end_angle < start_angle):
+                start_angle -= 360.0
+            segs = int((end_angle - start_angle) / 20) + 1
+            angleincr = (end_angle - start_angle) / segs
+            xstart = cos(start_angle * pi / 180) * radius + xcenter
+            ystart = sin(start_angle * pi / 180) * radius + ycenter
+            angle = start_angle
+            for i in range(segs):
+                angle += angleincr
+                xend = cos(angle * pi / 180) * radius + xcenter
+                yend = sin(angle * pi / 180) * radius + ycenter
+                coords = [xstart, ystart, xend, yend]
+                stroke_list += [text2laser.Line(coords)]
+                xmax = max(xmax, coords[0], coords[2])
+                ymax = max(ymax, coords[1], coords[3])
+                xstart = xend
+                ystart = yend
+
+        arc_cmd = re.match('^AR (.*)', text)
+        if arc_cmd:
+            cmds_read += 1
+            coords = arc_cmd.group(1)
+            coords = [float(n) for n in coords.split(',')]
+            xcenter, ycenter, radius, end_angle, start_angle = coords
+            if end_angle < start_angle:
+                start_angle -= 360.0
+            segs = int((end_angle - start_angle) / 20) + 1
+            angleincr = (end_angle - start_angle) / segs
+            xstart = cos(end_angle * pi / 180) * radius + xcenter
+            ystart = sin(end_angle * pi / 180) * radius + ycenter
+            angle = end_angle
+            for i in range(segs):
+                angle -= angleincr
+                xend = cos(angle * pi / 180) * radius + xcenter
+                yend = sin(angle * pi / 180) * radius + ycenter
+                coords = [xstart, ystart, xend, yend]
+                stroke_list += [text2laser.Line(coords)]
+                xmax = max(xmax, coords[0], coords[2])
+                ymax = max(ymax, coords[1], coords[3])
+                xstart = xend
+                ystart = yend
+
+    return font
+
+
+def new_parse(filename):
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    return text2laser.parse(data)
+
+
+def old_parse(filename):
+    f = open(filename)
+    font = regex_parse(f)
+    f.close()
+    return font
+
+
+def strokes(char):
+    return [[(l.xstart, l.ystart, l.xend, l.yend) for l in sg.lines] for sg in char.stroke_list_groups]
+
+
+def best_of(func, arg, repeat):
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        result = func(arg)
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+    return best, result
+
+
+class NullWriter:
+    def write(self, s):
+        pass
+
+
+def main():
+    repeat = 3
+    if len(sys.argv) > 1:
+        repeat = int(sys.argv[1])
+
+    # the parsers print warnings about the fonts, keep them off the table
+    stdout = sys.stdout
+    print "%-20s %7s %10s %10s %8s %6s" % ("font", "glyphs", "old ms", "new ms", "speedup", "diff")
+    total_old = total_new = 0
+    for filename in sorted(glob.glob(os.path.join(os.path.dirname(here), "cxf_fonts", "*.cxf"))):
+        name = os.path.basename(filename)
+        text2laser.fontfile = name
+        sys.stdout = NullWriter()
+        try:
+            t_old, old = best_of(old_parse, filename, repeat)
+            try:
+                t_new, new = best_of(new_parse, filename, repeat)
+            except ValueError:
+                new = None
+        finally:
+            sys.stdout = stdout
+        if old is None or new is None:
+            print "%-20s unsupported font version" % name
+            continue
+
+        # glyphs the old parser got wrong: strokes under a malformed
+        # header were glued to the previous glyph
+        diff = len(set(old) ^ set(new)) + len([k for k in new if k in old and strokes(old[k]) != strokes(new[k])])
+        total_old += t_old
+        total_new += t_new
+        print "%-20s %7d %10.2f %10.2f %7.1fx %6d" % (name, len(new), t_old * 1000, t_new * 1000, t_old / t_new, diff)
+
+    print "%-20s %7s %10.2f %10.2f %7.1fx" % ("total", "", total_old * 1000, total_new * 1000, total_old / total_new)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+#!/usr/bin/python
+
+"""
+    bench_suite.py
+    benchmarks of the hot paths of text2laser.py: parse() of every font
+    in cxf_fonts/, code() on short, long and many-line input, and whole
+    command line runs with a cold and a warm font cache. Results go to
+    JSON and are compared against a stored baseline; golden G-code
+    checks prove the fast paths still emit the same program.
+
+    usage: bench/bench_suite.py [options]
+       -r n              best of n runs, defaults to 5
+       -o file           write the results, defaults to bench/results.json
+       -b file           baseline to compare with, defaults to bench/baseline.json
+       -t percent        slower than the baseline by more than this is a
+                         regression, defaults to 25
+       --save-baseline   write the results as the new baseline
+       --update-golden   write the golden G-code instead of checking it
+       --no-timing       golden checks only
+
+    exits 1 on a regression or a golden mismatch
+"""
+
+import getopt
+import glob
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(here)
+sys.path.insert(0, top)
+import text2laser
+
+script = os.path.join(top, "text2laser.py")
+golden_dir = os.path.join(here, "golden")
+
+short_text = "Ab1"
+long_text = "The quick brown fox jumps over the lazy dog 0123456789 " * 4
+many_lines = ["SERIAL-%04d LOT 7 ABCDEFGHIJ" % i for i in range(100)]
+
+# (name, arguments) of the golden programs
+golden_cases = [
+    ("normal", ["-a", "Hello, World 0123", "-a", "Ab & (x)"]),
+    ("romans-angle", ["--font", "romans.cxf", "-S0.4", "-s0.5", "-A15", "-X3", "-Y7", "-a", "Line0 Ab", "-a", "zz"]),
+    ("mirror-flip", ["-M1", "-f1", "-S2", "-s1", "-x5", "-i1", "-y150", "-a", "Mir Flip", "-a", "second"]),
+    ("no-arcs", ["--no-arcs", "--font", "cursive.cxf", "-a", "Oboe 8"]),
+    ("arc-tolerance", ["--font", "greek_ol.cxf", "-S0.5", "-s0.7", "--arc-tolerance", "0.02", "-a", "Abc"]),
+    ("optimize", ["--optimize", "--font", "romans.cxf", "-a", "Hello (x) & 0", "-a", "Ob2"]),
+    ("simplify", ["--simplify-tolerance", "0.05", "-a", "Simplify 123"]),
+    ("compact-modal", ["--compact", "--modal", "--precision", "3", "-a", "Modal 42"]),
+    ("fill", ["--font", "greek_ol.cxf", "--fill", "0.4", "--fill-angle", "30", "-a", "O8 B"]),
+    ("array", ["--array", "2x2", "--array-pitch", "40x15", "-a", "SN {n:03d}", "-a", "LOT 7"]),
+    ("array-sub", ["--array", "2x3", "--array-pitch", "30x12", "--array-mode", "sub", "-a", "Ab", "-a", "{row}.{col}"]),
+    ("fit", ["--fit", "60x20", "-A10", "-a", "Fit me", "-a", "2"]),
+    ("power-merge", ["--power-mode", "group", "--merge-groups", "--line-power", "40,80", "--glyph-power", "O=100",
+                     "-a", "POWER", "-a", "OHO"]),
+    ("fallback", ["--font", "symbol_astro.cxf,romans.cxf", "-a", "a1 & b2"]),
+    ("estimate", ["--estimate", "--accel", "800", "-a", "Time 12", "-a", "ab"]),
+]
+
+# (name, arguments) of programs written by the original text2laser.py,
+# the first version in git, which cut arcs as line segments only; they
+# are checked with --no-arcs and --update-golden leaves them alone. Its
+# inside_cmp() sort scrambled the stroke groups of a glyph, so these
+# compare the groups of each character in any order, see same_strokes()
+baseline_cases = [
+    ("baseline-romans", ["--font", "romans.cxf", "-S0.4", "-s0.5", "-A15", "-X3", "-Y7",
+                         "-a", "Line0 Ab", "-a", "Hello, World 0123 & (x)", "-a", "zz", "-F4000"]),
+    ("baseline-greek", ["--font", "greek_ol.cxf", "-S0.7", "-s0.7", "-A-30", "-a", "Oboe 8 Abc"]),
+    ("baseline-mirror", ["--font", "romans.cxf", "-M1", "-f1", "-S2", "-s1", "-x5", "-i1", "-y150",
+                         "-a", "Mir Flip", "-a", "second"]),
+]
+
+# (name, arguments, arguments) that must give the same program
+same_cases = [
+    ("jobs", ["-a", "L0", "-a", "L1 ab", "-a", "L2 xy"], ["--jobs", "3", "-a", "L0", "-a", "L1 ab", "-a", "L2 xy"]),
+    ("layout-cache", ["-a", "AB", "-a", "AB"], ["--layout-cache", "0", "-a", "AB", "-a", "AB"]),
+    ("font-cache", ["--font", "romans.cxf", "-a", "Cache 1"], ["--rebuild-font-cache", "--font", "romans.cxf", "-a", "Cache 1"]),
+]
+
+
+class NullWriter:
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+
+def best_of(func, repeat):
+    # best time of one call; short calls are timed in batches of at
+    # least 20 ms, so that the timer resolution does not count
+    number = 1
+    while True:
+        t0 = time.time()
+        for i in range(number):
+            func()
+        best = time.time() - t0
+        if best >= 0.02:
+            break
+        number *= 10
+    for i in range(repeat - 1):
+        t0 = time.time()
+        for j in range(number):
+            func()
+        best = min(best, time.time() - t0)
+    return best / number
+
+
+# =======================================================================
+# timings, in seconds
+# =======================================================================
+def bench_parse(results, repeat):
+    stdout = sys.stdout
+    for filename in sorted(glob.glob(os.path.join(top, "cxf_fonts", "*.cxf"))):
+        name = os.path.basename(filename)
+        f = open(filename, 'rb')
+        data = f.read()
+        f.close()
+        text2laser.fontfile = name
+        sys.stdout = NullWriter()  # parse warnings
+        try:
+            try:
+                results["parse/" + name] = best_of(lambda: text2laser.parse(data), repeat)
+            except ValueError:
+                pass  # unsupported font version
+        finally:
+            sys.stdout = stdout
+
+
+def bench_code(results, repeat, cache):
+    os.environ["cxf_cache"] = cache
+    text2laser.font = text2laser.load_font(os.path.join(top, "cxf_fonts", "normal.cxf"))
+    text2laser.fontfile = "normal.cxf"
+    text2laser.YLineOffset = text2laser.line_offset(0)
+    text2laser.Output = text2laser.GcodeWriter(NullWriter())
+    # a fresh layout cache every time, the lines would all be hits
+    text2laser.LayoutCacheSize = 0
+
+    def lines(strings):
+        for index, item in enumerate(strings):
+            text2laser.code(item, index, index == len(strings) - 1)
+
+    results["code/short"] = best_of(lambda: lines([short_text]), repeat)
+    results["code/long"] = best_of(lambda: lines([long_text]), repeat)
+    results["code/many-lines"] = best_of(lambda: lines(many_lines), repeat)
+
+
+def run_cli(args, cache):
+    env = dict(os.environ)
+    env["cxf_cache"] = cache
+    p = subprocess.Popen([sys.executable, script] + args, cwd=top, env=env, stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    return out
+
+
+def bench_cli(results, repeat):
+    args = ["--font", "romans.cxf", "-a", "SN-0001", "-a", "LOT 7"]
+
+    def cold():
+        cache = tempfile.mkdtemp()
+        try:
+            run_cli(args, cache)
+        finally:
+            shutil.rmtree(cache)
+
+    cache = tempfile.mkdtemp()
+    try:
+        run_cli(args, cache)
+        results["cli/cold-cache"] = best_of(cold, repeat)
+        results["cli/warm-cache"] = best_of(lambda: run_cli(args, cache), repeat)
+    finally:
+        shutil.rmtree(cache)
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print "%-28s %10s %10s %8s" % ("benchmark", "ms", "base ms", "change")
+    for name in sorted(results):
+        t = results[name]
+        if name in baseline:
+            change = (t / baseline[name] - 1) * 100
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressions.append(name)
+            print "%-28s %10.3f %10.3f %+7.1f%%%s" % (name, t * 1000, baseline[name] * 1000, change, flag)
+        else:
+            print "%-28s %10.3f %10s" % (name, t * 1000, "-")
+    return regressions
+
+
+# =======================================================================
+# golden G-code. A change in the order of the transform arithmetic may
+# round the last printed digit of a coordinate differently (and give
+# -0.000000), so X, Y, I and J decimals match when within 1.5 units of
+# their last digit; all else, G words, S, F and comments, must be the
+# same.
+# =======================================================================
+coordinate = re.compile(r'\b([XYIJ])(-?\d+(?:\.\d*)?)')
+
+
+def same_gcode(a, b):
+    a = a.splitlines()
+    b = b.splitlines()
+    if len(a) != len(b):
+        return False
+    for la, lb in zip(a, b):
+        if la == lb:
+            continue
+        if la.startswith(';') or coordinate.sub(r'\1#', la) != coordinate.sub(r'\1#', lb):
+            return False
+        for (w, x), (w, y) in zip(coordinate.findall(la), coordinate.findall(lb)):
+            units = [10 ** -len(v.partition('.')[2]) for v in (x, y) if v.partition('.')[2]]
+            if not units:
+                if float(x) != float(y):
+                    return False
+            elif abs(float(x) - float(y)) > 1.5 * min(units):
+                return False
+    return True
+
+
+def strokes(gcode):
+    # the lines of a program, the stroke groups (a G00 and the cuts after
+    # it) between two other lines sorted, coordinates to 3 decimals
+    def rounded(m):
+        return "%s%.3f" % (m.group(1), round(float(m.group(2)), 3) + 0.)
+
+    out = []
+    groups = []
+    for line in gcode.splitlines():
+        if line.startswith(('G00', 'G01', 'G02', 'G03')):
+            line = coordinate.sub(rounded, line)
+            if line.startswith('G00') or not groups:
+                groups.append([])
+            groups[-1].append(line)
+            continue
+        out.extend(sum(sorted(groups), []))
+        groups = []
+        out.append(line)
+    out.extend(sum(sorted(groups), []))
+    return out
+
+
+def same_strokes(a, b):
+    return strokes(a) == strokes(b)
+
+
+def check_golden(cache, update):
+    failed = []
+    for name, args in golden_cases:
+        out = run_cli(args, cache)
+        filename = os.path.join(golden_dir, name + ".ngc")
+        if update:
+            f = open(filename, 'w')
+            f.write(out)
+            f.close()
+            print "golden %-20s written" % name
+            continue
+        f = open(filename)
+        golden = f.read()
+        f.close()
+        ok = same_gcode(out, golden)
+        print "golden %-20s %s" % (name, ok and "ok" or "DIFFERS")
+        if not ok:
+            failed.append(name)
+
+    for name, args in baseline_cases:
+        out = run_cli(["--no-arcs"] + args, cache)
+        f = open(os.path.join(golden_dir, name + ".ngc"))
+        golden = f.read()
+        f.close()
+        ok = same_strokes(out, golden)
+        print "golden %-20s %s" % (name, ok and "ok" or "DIFFERS")
+        if not ok:
+            failed.append(name)
+
+    for name, args1, args2 in same_cases:
+        ok = run_cli(args1, cache) == run_cli(args2, cache)
+        print "same   %-20s %s" % (name, ok and "ok" or "DIFFERS")
+        if not ok:
+            failed.append(name)
+    return failed
+
+
+def main():
+    repeat = 5
+    outfile = os.path.join(here, "results.json")
+    basefile = os.path.join(here, "baseline.json")
+    threshold = 25.
+    save = update = 0
+    timing = 1
+    try:
+        options, args = getopt.getopt(sys.argv[1:], 'r:o:b:t:h', ["save-baseline", "update-golden", "no-timing"])
+    except getopt.error:
+        print __doc__
+        sys.exit(2)
+    for o, a in options:
+        if o == '-h':
+            print __doc__
+            sys.exit(0)
+        if o == '-r':
+            repeat = int(a)
+        if o == '-o':
+            outfile = a
+        if o == '-b':
+            basefile = a
+        if o == '-t':
+            threshold = float(a)
+        if o == "--save-baseline":
+            save = 1
+        if o == "--update-golden":
+            update = 1
+        if o == "--no-timing":
+            timing = 0
+
+    cache = tempfile.mkdtemp()
+    try:
+        failed = check_golden(cache, update)
+        regressions = []
+        if timing:
+            results = {}
+            bench_parse(results, repeat)
+            bench_code(results, repeat, cache)
+            bench_cli(results, repeat)
+
+            baseline = {}
+            if os.path.exists(basefile) and not save:
+                f = open(basefile)
+                baseline = json.load(f)["results"]
+                f.close()
+            regressions = compare(results, baseline, threshold)
+
+            report = {
+                'python': platform.python_version(),
+                'numpy': text2laser.load_numpy() is not None and text2laser.numpy.__version__ or None,
+                'machine': platform.machine(),
+                'repeat': repeat,
+                'results': results,
+            }
+            if save:
+                outfile = basefile
+            f = open(outfile, 'w')
+            json.dump(report, f, indent=1, sort_keys=True)
+            f.close()
+            print "results written to %s" % outfile
+    finally:
+        shutil.rmtree(cache)
+
+    if failed or regressions:
+        print "%d golden mismatches, %d regressions" % (len(failed), len(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
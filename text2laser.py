@@ -32,11 +32,29 @@
     Rev v2 21.06.2012 ArcEye
 """
 
+import cStringIO
+import collections
 import getopt
+import glob
+import hashlib
+import json
+import mmap
+import os
 import re
+import struct
 import sys
+import time
+import traceback
 from math import *
 
+numpy = None  # imported by load_numpy(), only the preview wants it
+NumpyTried = False
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
 # change this if you want to use another font
 fontfile = "normal.cxf"
 laser_range = 1000.
@@ -63,6 +81,21 @@ Flip = 0
 Spindle = 0.
 font = None
 
+# arcs in the font are approximated with a line segment every ArcSegDeg degrees,
+# or, with ArcTolerance, with segments deviating at most ArcTolerance mm
+ArcSegDeg = 20
+ArcTolerance = 0.
+# parsed fonts are cached in binary form, see load_font()
+FontCacheVersion = 6
+RebuildFontCache = 0
+# order stroke groups of the whole job for minimum rapid travel
+OptimizePaths = 0
+# G02/G03 for the arcs of the font when X and Y scale are the same
+NativeArcs = 1
+# join and straighten glyph polylines, Douglas-Peucker tolerance in mm
+Simplify = 0
+SimplifyTolerance = 0.
+
 Preamble = """
 G21         ; Set units to mm
 M4 S0       ; Enable Laser/Spindle (0 power)
@@ -76,16 +109,98 @@ stringlist = []
 p = {}
 
 
+# =======================================================================
+# Stage timing and counters for --stats. Stages nest, a stage is only
+# charged its own time, so together with "other" they add up to the
+# wall time. Timed per line, glyph or write, never per vertex, so it is
+# always on. Worker processes of --jobs keep their own.
+# =======================================================================
+class StageTimer:
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self.stack = []
+        self.start = self.mark = time.time()
+
+    def begin(self, name):
+        now = time.time()
+        if self.stack:
+            top = self.stack[-1]
+            self.times[top] = self.times.get(top, 0.) + now - self.mark
+        self.stack.append(name)
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.mark = now
+
+    def end(self):
+        now = time.time()
+        name = self.stack.pop()
+        self.times[name] = self.times.get(name, 0.) + now - self.mark
+        self.mark = now
+
+
+Timer = StageTimer()
+Counts = {'G00': 0, 'G01': 0, 'G02': 0, 'G03': 0, 'merged': 0, 'blocks': 0, 'bytes': 0,
+          'chars': 0, 'glyphs loaded': 0, 'glyphs compiled': 0}
+
+
 # =======================================================================
 class Character:
     def __init__(self, key):
         self.key = key
         self.stroke_list = []
         self.stroke_list_groups = []
+        self.centers = []  # arc centers, see Line.arc
+        self.vertices = None
+        self.timing = {}  # (seconds, length, moves) of its groups, see estimate_line()
+        self.fills = {}  # the glyph hatched, see filled_glyph()
 
     def __repr__(self):
         return "%s" % (self.stroke_list)
 
+    def compile(self):
+        # the stroke groups as one contiguous run of vertices, ready to be
+        # offset and transformed: a group starts at vertices[starts[i]],
+        # the rapid target, the following vertices are the ends of its cuts.
+        # moves holds the gcode_move() p1 of every vertex, inner the groups that
+        # have to be cut before each group (see inside_first()).
+        # A vertex ending an arc segment has in arcs its Line.arc tag and
+        # the offset from the previous vertex to the arc center.
+        groups = self.stroke_list_groups
+        inner = [[j for j, g2 in enumerate(groups) if inside(g2, g1)] for g1 in groups]
+        paths = []
+        for sg in groups:
+            path = [(sg.lines[0].xstart, sg.lines[0].ystart, 0)]
+            for line in sg.lines:
+                path.append((line.xend, line.yend, line.arc))
+            paths.append(path)
+        if Simplify:
+            paths, inner = simplify(paths, inner)
+
+        vertices = []
+        starts = []
+        arcs = []
+        for path in paths:
+            starts.append(len(vertices))
+            for x, y, tag in path:
+                if tag:
+                    cx, cy = self.centers[abs(tag) - 1]
+                    px, py = vertices[-1]
+                    arcs.append((tag, cx - px, cy - py))
+                else:
+                    arcs.append(None)
+                vertices.append((x, y))
+        moves = [1.] * len(vertices)
+        for start in starts:
+            moves[start] = 0.
+
+        self.inner = inner
+        self.arcs = arcs
+        self.has_arcs = len(self.centers) > 0
+        self.vertices = vertices
+        self.starts = starts
+        self.moves = moves
+        self.advance = self.get_xmax()
+
     def get_xmax(self):
         try:
             return max([s.xmax for s in self.stroke_list[:]])
@@ -98,8 +213,22 @@ class Character:
         except ValueError:
             return 0
 
+    def get_bbox(self):
+        return strokes_bbox(self.stroke_list)
+
+
+def strokes_bbox(lines):
+    # (xmin, ymin, xmax, ymax), all 0 for an empty glyph
+    if not lines:
+        return 0, 0, 0, 0
+    return (min([s.xmin for s in lines]), min([s.ymin for s in lines]),
+            max([s.xmax for s in lines]), max([s.ymax for s in lines]))
+
 # =======================================================================
 class Line:
+    # segment of a tessellated arc: +n for the ccw arc centers[n - 1] of
+    # the glyph, -n cw, 0 for a straight line
+    arc = 0
 
     def __init__(self, coords):
         self.xstart, self.ystart, self.xend, self.yend = coords
@@ -128,10 +257,10 @@ class StrokeGroup:
         self.ymin = min(self.ymin, line.ymin)
 
 
-def inside_cmp(g1, g2):
-    if g1.xmin < g2.xmin and g1.xmax > g2.xmax and g1.ymin < g2.ymin and g1.ymax > g2.xmax:
-        return 1
-    return -1
+def inside(g1, g2):
+    # bounding box of g1 strictly inside the one of g2
+    return g2.xmin < g1.xmin and g1.xmax < g2.xmax and g2.ymin < g1.ymin and g1.ymax < g2.ymax
+
 
 def inside_first(strokes):
     # pass1 : divide strokes
@@ -149,8 +278,27 @@ def inside_first(strokes):
         stroke_group.addLine(stroke)
         o_stroke = stroke
 
-    # pass2: order stroke, first inside one
-    stroke_groups.sort(inside_cmp)
+    # pass2: order stroke, first inside one. Containment is only a partial
+    # order, so pick in font order the first group that no longer encloses
+    # a pending one
+    inner = [0] * len(stroke_groups)
+    outer = [[] for sg in stroke_groups]
+    for i, g1 in enumerate(stroke_groups):
+        for j, g2 in enumerate(stroke_groups):
+            if i != j and inside(g1, g2):
+                inner[j] += 1
+                outer[i].append(j)
+    order = []
+    pending = range(len(stroke_groups))
+    while pending:
+        for i in pending:
+            if inner[i] == 0:
+                break
+        pending.remove(i)
+        order.append(i)
+        for j in outer[i]:
+            inner[j] -= 1
+    stroke_groups = [stroke_groups[i] for i in order]
 
     # pass3: return order strokes
     order_strokes = []
@@ -162,121 +310,768 @@ def inside_first(strokes):
 
 
 # =======================================================================
-# This routine parses the .cxf font file and builds a font dictionary of
-# line segment strokes required to cut each character.
-# Arcs (only used in some fonts) are converted to a number of line
-# segemnts based on the angular length of the arc. Since the idea of
-# this font description is to make it support independant x and y scaling,
-# we can not use native arcs in the gcode.
+# Geometry simplification of the compiled glyph polylines, in font units:
+# a group starting (or, if open, ending) where the previous one ends is
+# joined to it, vertices in the middle of a straight run are dropped
+# and, with a tolerance, Douglas-Peucker removes the vertices closer
+# than SimplifyTolerance mm to the simplified path. The tolerance is
+# converted to font units with the largest scale, so the deviation
+# stays within it after an anisotropic scaling too.
+# Groups are only joined in their cut order, which keeps inside first.
+# A path vertex is (x, y, arc), arc being the Line.arc tag of the segment
+# ending there; vertices where a line meets an arc are always kept.
 # =======================================================================
-def parse(filein):
-    font = {}
-    key = None
-    num_cmds = 0
-    line_num = 0
-    xmax, ymax = 0, 0
-
-    for text in filein:
-        # format for a typical letter (lowercase r):
-        ##comment, with a blank line after it
-        #
-        # [r] 3
-        # L 0,0,0,6
-        # L 0,6,2,6
-        # A 2,5,1,0,90
-        #
-        line_num += 1
-        end_char = re.match('^$', text)  # blank line
-        if end_char and key:  # save the character to our dictionary
-            font[key] = Character(key)
-
-            font[key].stroke_list_groups, font[key].stroke_list = inside_first(stroke_list)
-
-            font[key].xmax = xmax
-            if num_cmds != cmds_read:
-                print "; warning: discrepancy in number of commands %s, line %s, %s != %s " % (
-                fontfile, line_num, num_cmds, cmds_read)
-
-        version_ = re.match('^# Version:\s+([\d\.]+)', text)
-        if version_:
-            version = version_.group(1)
-            if version.split('.')[0] != '1':
-                print "; Unsupported font version (%s)" % (fontfile)
-                sys.exit(1)
+CollinearEps = 1e-6
+
+
+def reverse_path(path):
+    # the same path cut backwards, arcs change direction
+    out = [(path[-1][0], path[-1][1], 0)]
+    for i in range(len(path) - 1, 0, -1):
+        out.append((path[i - 1][0], path[i - 1][1], -path[i][2]))
+    return out
+
 
-        new_cmd = re.match('^\[(.+?)\]\s+(\d+)', text)
-        if new_cmd:  # new character
-            key = new_cmd.group(1)
-            num_cmds = int(new_cmd.group(2))  # for debug
-            cmds_read = 0
-            stroke_list = []
-            xmax, ymax = 0, 0
-
-#        new_cmd = re.match('^\[(\d+)\]\s+(.)', text)
-#        if new_cmd:  # new character
-#            ccode = int(new_cmd.group(1), 16)
-
-        line_cmd = re.match('^L (.*)', text)
-        if line_cmd:
-            cmds_read += 1
-            coords = line_cmd.group(1)
-            coords = [float(n) for n in coords.split(',')]
-            stroke_list += [Line(coords)]
+def join_paths(paths, inner):
+    joined = []
+    owner = []  # index in joined of every path
+    for path in paths:
+        if joined:
+            last = joined[-1][-1]
+            if hypot(path[0][0] - last[0], path[0][1] - last[1]) < 0.001:
+                joined[-1].extend(path[1:])
+                owner.append(len(joined) - 1)
+                continue
+            if hypot(path[-1][0] - last[0], path[-1][1] - last[1]) < 0.001 and \
+                    hypot(path[-1][0] - path[0][0], path[-1][1] - path[0][1]) >= 0.001:
+                joined[-1].extend(reverse_path(path)[1:])
+                owner.append(len(joined) - 1)
+                continue
+        joined.append(list(path))
+        owner.append(len(joined) - 1)
+
+    joined_inner = [set() for path in joined]
+    for k in range(len(paths)):
+        for j in inner[k]:
+            if owner[j] != owner[k]:
+                joined_inner[owner[k]].add(owner[j])
+    return joined, [sorted(s) for s in joined_inner]
+
+
+def collapse_collinear(path):
+    out = [path[0]]
+    for i in range(1, len(path) - 1):
+        ax, ay = out[-1][:2]
+        bx, by, barc = path[i]
+        cx, cy, carc = path[i + 1]
+        if barc or carc:
+            out.append(path[i])
+            continue
+        if hypot(bx - ax, by - ay) <= CollinearEps:
+            continue
+        # b on the line a-c, going on in the same direction
+        cross = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+        dot = (bx - ax) * (cx - bx) + (by - ay) * (cy - by)
+        if dot > 0 and abs(cross) <= CollinearEps * hypot(cx - ax, cy - ay):
+            continue
+        out.append(path[i])
+    out.append(path[-1])
+    return out
+
+
+def douglas_peucker(path, tolerance):
+    keep = [False] * len(path)
+    keep[0] = keep[-1] = True
+    for i in range(1, len(path) - 1):
+        if path[i][2] != path[i + 1][2]:
+            keep[i] = True
+    kept = [i for i in range(len(path)) if keep[i]]
+    stack = zip(kept[:-1], kept[1:])
+    while stack:
+        first, last = stack.pop()
+        ax, ay = path[first][:2]
+        bx, by = path[last][:2]
+        length = hypot(bx - ax, by - ay)
+        dmax, imax = 0, first
+        for i in range(first + 1, last):
+            px, py = path[i][:2]
+            if length > 0:
+                d = abs((bx - ax) * (ay - py) - (ax - px) * (by - ay)) / length
+            else:
+                d = hypot(px - ax, py - ay)
+            if d > dmax:
+                dmax, imax = d, i
+        if dmax > tolerance:
+            keep[imax] = True
+            stack.append((first, imax))
+            stack.append((imax, last))
+    return [pt for pt, k in zip(path, keep) if k]
+
+
+def simplify(paths, inner):
+    paths, inner = join_paths(paths, inner)
+    paths = [collapse_collinear(path) for path in paths]
+    if SimplifyTolerance > 0:
+        tolerance = SimplifyTolerance / max(abs(XScale), abs(YScale))
+        paths = [douglas_peucker(path, tolerance) for path in paths]
+    return paths, inner
+
+
+# =======================================================================
+# Fill. The closed rings of a glyph, see fill_polygons(), are taken as
+# polygons, even odd, and hatched with scanlines Fill mm apart at FillAngle degrees on
+# the machine. Scanlines are worked out in the glyph scaled to mm and
+# turned so that they run along x, from an edge table swept upwards.
+# Hatch segments that overlap from one scanline to the next make a run,
+# cut back and forth; the hatched glyph is kept per pitch, angle and
+# scale, its hatch segments are groups of one cut after its outline.
+# =======================================================================
+Fill = 0.  # mm, 0 for outlines only
+FillAngle = 0.
+
+
+def fill_key():
+    # what the hatch of a glyph depends on, None without fill
+    if not Fill:
+        return None
+    sx = XScale
+    sy = YScale
+    if Mirror == 1:
+        sx = -sx
+    if Flip == 1:
+        sy = -sy
+    return (Fill, FillAngle - Angle, sx, sy)
+
+
+def same_point(a, b):
+    return abs(a[0] - b[0]) < 1e-6 and abs(a[1] - b[1]) < 1e-6
+
+
+def fill_polygons(glyph):
+    # closed rings of the glyph: its closed groups, and open groups
+    # joined end to end into a ring that closes; what does not close,
+    # a stem or a crossing stroke, is left out
+    rings = []
+    opened = []
+    bounds = glyph.starts + [len(glyph.vertices)]
+    for g in range(len(glyph.starts)):
+        path = glyph.vertices[bounds[g]:bounds[g + 1]]
+        if len(path) < 2:
+            continue
+        if same_point(path[0], path[-1]):
+            if len(path) > 3:
+                rings.append(path)
+        else:
+            opened.append(path)
+
+    used = [False] * len(opened)
+    for i, path in enumerate(opened):
+        if used[i]:
+            continue
+        used[i] = True
+        ring = list(path)
+        members = []
+        while not same_point(ring[0], ring[-1]):
+            for j, other in enumerate(opened):
+                if used[j]:
+                    continue
+                if same_point(other[0], ring[-1]):
+                    ring.extend(other[1:])
+                    break
+                if same_point(other[-1], ring[-1]):
+                    ring.extend(other[-2::-1])
+                    break
+            else:
+                break
+            used[j] = True
+            members.append(j)
+        if same_point(ring[0], ring[-1]) and len(ring) > 3:
+            rings.append(ring)
+        else:
+            for j in members:
+                used[j] = False
+    return rings
+
+
+def scanlines(polygons, pitch):
+    # (y, [(x0, x1), ...]) of the scanlines y = k * pitch, the spans inside
+    # polygons by the even-odd rule
+    edges = []
+    for poly in polygons:
+        for i in range(len(poly) - 1):
+            x0, y0 = poly[i]
+            x1, y1 = poly[i + 1]
+            if y0 == y1:
+                continue
+            if y0 > y1:
+                x0, y0, x1, y1 = x1, y1, x0, y0
+            edges.append((y0, y1, x0, (x1 - x0) / (y1 - y0)))
+    if not edges:
+        return []
+    edges.sort()
+    ymax = max([edge[1] for edge in edges])
+
+    rows = []
+    active = []
+    e = 0
+    k = int(ceil(edges[0][0] / pitch))
+    while k * pitch < ymax:
+        y = k * pitch
+        while e < len(edges) and edges[e][0] <= y:
+            active.append(edges[e])
+            e += 1
+        active = [edge for edge in active if edge[1] > y]
+        xs = sorted([x0 + (y - y0) * slope for y0, y1, x0, slope in active])
+        spans = [(xs[i], xs[i + 1]) for i in range(0, len(xs) - 1, 2) if xs[i + 1] - xs[i] > 1e-9]
+        if spans:
+            rows.append((y, spans))
+        k += 1
+    return rows
+
+
+def hatch_runs(rows):
+    # spans chained into runs of spans overlapping the one below, each
+    # cut back and forth; returns the hatch segments in cutting order
+    runs = []
+    open_runs = []
+    for y, spans in rows:
+        extended = []
+        for x0, x1 in spans:
+            for run in open_runs:
+                last = run[-1]
+                if last[0] == y or not (x0 < last[2] and last[1] < x1):
+                    continue
+                run.append((y, x0, x1))
+                break
+            else:
+                run = [(y, x0, x1)]
+                runs.append(run)
+            extended.append(run)
+        open_runs = extended
+
+    segments = []
+    for run in runs:
+        for i, (y, x0, x1) in enumerate(run):
+            if i % 2:
+                segments.append(((x1, y), (x0, y)))
+            else:
+                segments.append(((x0, y), (x1, y)))
+    return segments
+
+
+def filled_glyph(glyph):
+    # the glyph with the hatch of fill_key() added
+    key = fill_key()
+    filled = glyph.fills.get(key)
+    if filled is not None:
+        return filled
+
+    pitch, angle, sx, sy = key
+    a = angle * Deg2Rad
+    c = cos(a)
+    s = sin(a)
+    # in mm, turned by -angle
+    polygons = [[(c * x * sx + s * y * sy, -s * x * sx + c * y * sy) for x, y in poly]
+                for poly in fill_polygons(glyph)]
+    vertices = []
+    for start, end in hatch_runs(scanlines(polygons, pitch)):
+        for u, v in (start, end):
+            vertices.append(((c * u - s * v) / sx, (s * u + c * v) / sy))
+
+    filled = Character(glyph.key)
+    filled.stroke_list = glyph.stroke_list
+    filled.stroke_list_groups = glyph.stroke_list_groups
+    filled.centers = glyph.centers
+    base = len(glyph.vertices)
+    count = len(vertices) // 2
+    filled.vertices = glyph.vertices + vertices
+    filled.starts = glyph.starts + [base + 2 * i for i in range(count)]
+    filled.moves = glyph.moves + [0., 1.] * count
+    filled.inner = glyph.inner + [[] for i in range(count)]
+    filled.arcs = glyph.arcs + [None] * len(vertices)
+    filled.has_arcs = glyph.has_arcs
+    filled.advance = glyph.advance
+    glyph.fills[key] = filled
+    return filled
+
+
+# =======================================================================
+# Arc tessellation. With ArcTolerance the segment count of an arc follows
+# from the chord error: a chord spanning angle a of radius r is at most
+# r * (1 - cos(a / 2)) away from the arc, the radius taken in mm with
+# the largest of XScale and YScale. Small text gets few segments, large
+# text stays smooth. Without it, a segment every ArcSegDeg degrees.
+# =======================================================================
+def arc_tolerance():
+    # ArcTolerance in font units
+    return ArcTolerance / (max(abs(XScale), abs(YScale)) or 1)
+
+
+def arc_segments(span, radius):
+    if ArcTolerance > 0:
+        tolerance = arc_tolerance()
+        if radius <= tolerance / 2:
+            return 1
+        step = 2 * acos(1 - tolerance / radius) * 180 / pi
+        return max(1, int(ceil(span / step - 1e-9)))
+    return int(span / ArcSegDeg) + 1
+
+
+def tessellation_key():
+    # tessellation settings, kept with the bounding boxes in the font cache
+    if ArcTolerance > 0:
+        return "arctol=%r" % arc_tolerance()
+    return "arcseg=%s" % ArcSegDeg
+
+
+def geometry_key():
+    # what the glyphs of a loaded font depend on besides its file: the
+    # tessellation and the simplification, both in font units
+    key = tessellation_key()
+    if Simplify:
+        tolerance = 0.
+        if SimplifyTolerance > 0:
+            tolerance = SimplifyTolerance / max(abs(XScale), abs(YScale))
+        key += ",simplify=%r" % tolerance
+    return key
+
+
+def arc_segment_count(lines):
+    # line segments the program of lines cuts arcs with, every character
+    # counted; with native arcs only those of an arc too small for a
+    # G02/G03, see arc_moves()
+    native = native_arcs()
+    count = 0
+    for char in glyph_keys(''.join(lines)):
+        if char not in font:
+            continue
+        glyph = font[char]
+        if glyph.vertices is None:
+            glyph.compile()
+        k = 0
+        while k < len(glyph.arcs):
+            arc = glyph.arcs[k]
+            if arc is None or glyph.moves[k] < 0.5:
+                k += 1
+                continue
+            j = k
+            while j + 1 < len(glyph.arcs) and glyph.arcs[j + 1] is not None and glyph.arcs[j + 1][0] == arc[0]:
+                j += 1
+            if not native or hypot(arc[1], arc[2]) * abs(p[1004]) < 1e-4:
+                count += j - k + 1
+            k = j + 1
+    return count
+
+
+# =======================================================================
+# This routine parses one glyph of the .cxf font file into line segment
+# strokes required to cut the character: glyph_commands() reads the
+# commands, which the font cache keeps, glyph_strokes() makes them
+# strokes and build_glyph() groups these.
+# Arcs (only used in some fonts) are converted to a number of line
+# segments based on the chord tolerance (see arc_segments()), each tagged
+# with its arc: the font supports independant x and y scaling, which
+# needs the segments, while with equal scales the run of an arc is
+# written as a native G02/G03 (see native_arcs()).
+# =======================================================================
+def parse_glyph(key, num_cmds, block):
+    kinds, values = glyph_commands(block)
+    char = build_glyph(key, kinds, values)
+    if num_cmds != len(kinds):
+        print "; warning: discrepancy in number of commands %s, glyph [%s], %s != %s " % (
+        fontfile, key, num_cmds, len(kinds))
+    return char
+
+
+def glyph_commands(block):
+    # format for a typical letter (lowercase r), block holds the lines
+    # between the [r] header and the blank line:
+    ##comment, with a blank line after it
+    #
+    # [r] 3
+    # L 0,0,0,6
+    # L 0,6,2,6
+    # A 2,5,1,0,90
+    #
+    # Returns kinds, a string of L (line), A (arc) and R (AR, the arc
+    # backwards), and the values of the commands in one list, CommandSize
+    # of them each.
+    # pass1: tokenize, dispatching on the first character of each line
+    kinds = []
+    args = []
+    for text in block.split('\n'):
+        c = text[:1]
+        if c == 'L':
+            if text[1:2] == ' ':
+                kinds.append('L')
+                args.append(text[2:])
+        elif c == 'A':
+            if text[1:2] == ' ':
+                kinds.append('A')
+                args.append(text[2:])
+            elif text[1:3] == 'R ':
+                kinds.append('R')
+                args.append(text[3:])
+    for kind, arg in zip(kinds, args):
+        if arg.count(',') + 1 != CommandSize[kind]:
+            raise ValueError("bad glyph command %s %s" % (kind, arg))
+
+    # pass2: convert the coordinates of the whole glyph in one go
+    values = []
+    if args:
+        values = [float(n) for n in ','.join(args).split(',')]
+    return ''.join(kinds), values
+
+
+CommandSize = {'L': 4, 'A': 5, 'R': 5}
+
+
+def glyph_strokes(kinds, values):
+    # pass3: the Lines of the commands, arcs tessellated as the settings
+    # ask (see arc_segments()) and tagged, the arc centers and the
+    # largest x
+    stroke_list = []
+    centers = []
+    xmax = 0
+    pos = 0
+    for kind in kinds:
+        coords = values[pos:pos + CommandSize[kind]]
+        pos += CommandSize[kind]
+        if kind == 'L':
+            stroke_list.append(Line(coords))
             xmax = max(xmax, coords[0], coords[2])
-            ymax = max(ymax, coords[1], coords[3])
+            continue
 
-        arc_cmd = re.match('^A (.*)', text)
-        if arc_cmd:
-            cmds_read += 1
-            coords = arc_cmd.group(1)
-            coords = [float(n) for n in coords.split(',')]
+        if kind == 'A':
             xcenter, ycenter, radius, start_angle, end_angle = coords
-            # since font defn has arcs as ccw, we need some font foo
-            if (end_angle < start_angle):
-                start_angle -= 360.0
-            # approximate arc with line seg every 20 degrees
-            segs = int((end_angle - start_angle) / 20) + 1
-            angleincr = (end_angle - start_angle) / segs
-            xstart = cos(start_angle * pi / 180) * radius + xcenter
-            ystart = sin(start_angle * pi / 180) * radius + ycenter
-            angle = start_angle
-            for i in range(segs):
-                angle += angleincr
-                xend = cos(angle * pi / 180) * radius + xcenter
-                yend = sin(angle * pi / 180) * radius + ycenter
-                coords = [xstart, ystart, xend, yend]
-                stroke_list += [Line(coords)]
-                xmax = max(xmax, coords[0], coords[2])
-                ymax = max(ymax, coords[1], coords[3])
-                xstart = xend
-                ystart = yend
-
-        arc_cmd = re.match('^AR (.*)', text)
-        if arc_cmd:
-            cmds_read += 1
-            coords = arc_cmd.group(1)
-            coords = [float(n) for n in coords.split(',')]
+        else:
             xcenter, ycenter, radius, end_angle, start_angle = coords
-            # since font defn has arcs as ccw, we need some font foo
-            if end_angle < start_angle:
-                start_angle -= 360.0
-            # approximate arc with line seg every 20 degrees
-            segs = int((end_angle - start_angle) / 20) + 1
-            angleincr = (end_angle - start_angle) / segs
-            xstart = cos(end_angle * pi / 180) * radius + xcenter
-            ystart = sin(end_angle * pi / 180) * radius + ycenter
+        # since font defn has arcs as ccw, we need some font foo
+        if end_angle < start_angle:
+            start_angle -= 360.0
+        # approximate arc with line segs, see arc_segments(),
+        # A runs from start to end angle, AR backwards
+        segs = arc_segments(end_angle - start_angle, radius)
+        angleincr = (end_angle - start_angle) / segs
+        centers.append((xcenter, ycenter))
+        if kind == 'A':
+            angle = start_angle
+            tag = len(centers)
+        else:
             angle = end_angle
-            for i in range(segs):
-                angle -= angleincr
-                xend = cos(angle * pi / 180) * radius + xcenter
-                yend = sin(angle * pi / 180) * radius + ycenter
-                coords = [xstart, ystart, xend, yend]
-                stroke_list += [Line(coords)]
-                xmax = max(xmax, coords[0], coords[2])
-                ymax = max(ymax, coords[1], coords[3])
-                xstart = xend
-                ystart = yend
+            angleincr = -angleincr
+            tag = -len(centers)
+        xstart = cos(angle * pi / 180) * radius + xcenter
+        ystart = sin(angle * pi / 180) * radius + ycenter
+        for i in range(segs):
+            angle += angleincr
+            xend = cos(angle * pi / 180) * radius + xcenter
+            yend = sin(angle * pi / 180) * radius + ycenter
+            line = Line((xstart, ystart, xend, yend))
+            line.arc = tag
+            stroke_list.append(line)
+            xmax = max(xmax, xstart, xend)
+            xstart = xend
+            ystart = yend
+    return stroke_list, centers, xmax
+
+
+def build_glyph(key, kinds, values):
+    # the Character of the commands of a glyph, its strokes grouped
+    stroke_list, centers, xmax = glyph_strokes(kinds, values)
+    char = Character(key)
+    char.centers = centers
+    Timer.begin('inside_first')
+    char.stroke_list_groups, char.stroke_list = inside_first(stroke_list)
+    Timer.end()
+    char.xmax = xmax
+    return char
+
+
+# =======================================================================
+# Glyph offset index: maps every glyph key to the (start, end) byte range
+# of its command lines and the command count of its header. Only glyph
+# headers are looked at, so indexing a font is cheap even for the CJK
+# ones; the glyphs themselves are parsed later by parse_glyph().
+# A glyph is only defined once its blank line is reached, a later
+# definition of the same key wins. A font of another version than 1 is
+# a ValueError, a batch or server job with it is skipped.
+# =======================================================================
+glyph_header = re.compile(r'^\[(.+?)\][^\S\n]+(\d+)', re.M)
+font_version = re.compile(r'^# Version:\s+([\d\.]+)', re.M)
+
+
+def index_font(data):
+    for version_ in font_version.finditer(data):
+        version = version_.group(1)
+        if version.split('.')[0] != '1':
+            raise ValueError("Unsupported font version (%s)" % (fontfile))
+
+    index = {}
+    headers = list(glyph_header.finditer(data))
+    for i, header in enumerate(headers):
+        start = data.find('\n', header.end())
+        end = data.find('\n\n', start)
+        if start == -1 or end == -1:
+            continue
+        if i + 1 < len(headers) and headers[i + 1].start() < end:
+            continue
+        index[header.group(1)] = (start + 1, end, int(header.group(2)))
+    return index
+
+
+def parse(data):
+    index = index_font(data)
+    font = {}
+    for key in index:
+        start, end, num_cmds = index[key]
+        font[key] = parse_glyph(key, num_cmds, data[start:end])
+    return font
+
+
+# =======================================================================
+# Lazy font: a mapping of glyph key to Character that builds a glyph the
+# first time it is looked up, so a job only pays for the characters it
+# engraves. loader(key, index[key]) returns the Character, commands(key)
+# the glyph_commands() it is built from.
+# =======================================================================
+class Font:
+    def __init__(self, index, loader, commands, metrics=None):
+        self.index = index
+        self.loader = loader
+        self.commands = commands
+        self.metrics = metrics
+        self.glyphs = {}
+
+    def __getitem__(self, key):
+        try:
+            return self.glyphs[key]
+        except KeyError:
+            entry = self.index[key]  # KeyError for a glyph not in the font
+            Timer.begin('glyph')
+            try:
+                char = self.glyphs[key] = self.loader(key, entry)
+            finally:
+                Timer.end()
+            Counts['glyphs loaded'] += 1
+            return char
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def memory(self):
+        # rough bytes held by the directory and the glyphs loaded so far,
+        # the font data itself is mapped from the file
+        size = 150 * len(self.index)
+        for glyph in self.glyphs.values():
+            size += 250 * len(glyph.stroke_list)
+            if glyph.vertices is not None:
+                size += 200 * len(glyph.vertices)
+        return size
+
+    def bbox(self, key):
+        # the box of a glyph not loaded yet comes from its strokes alone,
+        # without building the Character or grouping them
+        if key in self.glyphs:
+            return self.glyphs[key].get_bbox()
+        return strokes_bbox(glyph_strokes(*self.commands(key))[0])
+
+    def get_metrics(self):
+        if self.metrics is None:
+            self.metrics = FontMetrics(dict((key, self.bbox(key)) for key in self))
+        return self.metrics
+
+
+# =======================================================================
+# Font wide metrics, computed once when the font is loaded (and kept in
+# the font cache) instead of scanning every glyph on every line.
+# bboxes maps each glyph key to (xmin, ymin, xmax, ymax) in font units,
+# xmax being the advance code() uses. line_height is the tallest glyph,
+# as the line spacing has always been computed; descent is the depth
+# below the baseline.
+# =======================================================================
+class FontMetrics:
+    def __init__(self, bboxes):
+        self.bboxes = bboxes
+        self.max_advance = max([b[2] for b in bboxes.values()] or [0])
+        self.ascent = max([b[3] for b in bboxes.values()] or [0])
+        self.descent = -min([b[1] for b in bboxes.values()] or [0])
+        self.line_height = self.ascent
+
+    def advance(self, key):
+        return self.bboxes[key][2]
+
+
+def open_font(filename):
+    f = open(filename, 'rb')
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, mmap.error):
+        data = ''  # empty file
+    f.close()
+
+    index = index_font(data)
+
+    def load_glyph(key, entry):
+        start, end, num_cmds = entry
+        return parse_glyph(key, num_cmds, data[start:end])
+
+    def commands(key):
+        start, end, num_cmds = index[key]
+        return glyph_commands(data[start:end])
+
+    return Font(index, load_glyph, commands)
+
+
+# =======================================================================
+# Binary font cache.
+# Indexing and reading a big font costs far more than engraving a short
+# string, so the glyph commands (see glyph_commands()), lines and whole
+# arcs, are saved in a compact binary file and reloaded on the next run;
+# a glyph is tessellated and grouped when it is used, as it is from the
+# font file, so one cache serves every scale and arc tolerance. The
+# cache is stamped with font path, mtime and size; any change makes
+# load_font() parse again. The file starts with a glyph directory with
+# the bounding boxes of the tessellation it was written with, so a run
+# only decodes the glyphs it uses; with another tessellation the boxes
+# of the glyphs with arcs are worked out again.
+#
+# layout (little endian):
+#   'T2LF' version:H stamplen:H stamp tesslen:H tessellation nglyphs:I
+#   directory, per glyph: keylen:H key narcs:H bbox:4d offset:I
+#   records, per glyph: ncommands:I kinds:c*ncommands values:d*nvalues
+# =======================================================================
+def font_cache_dir():
+    if os.getenv("cxf_cache"):
+        return os.getenv("cxf_cache")
+    return os.path.join(os.getenv("HOME") or ".", ".cxf_fonts", "cache")
+
+
+def font_cache_stamp(filename):
+    st = os.stat(filename)
+    return "%s:%d:%d" % (os.path.abspath(filename), int(st.st_mtime), st.st_size)
+
+
+def font_cache_file(filename):
+    name = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+    return os.path.join(font_cache_dir(), name + ".bin")
+
+
+def save_font_cache(font, cachefile, stamp):
+    # the metrics of a font just parsed come in the same pass
+    keys = font.keys()
+    records = []
+    narcs = []
+    bboxes = {}
+    for key in keys:
+        kinds, values = font.commands(key)
+        records.append(struct.pack('<I', len(kinds)) + kinds + struct.pack('<%dd' % len(values), *values))
+        narcs.append(len(kinds) - kinds.count('L'))
+        if font.metrics is None:
+            bboxes[key] = strokes_bbox(glyph_strokes(kinds, values)[0])
+    if font.metrics is None:
+        font.metrics = FontMetrics(bboxes)
+
+    tessellation = tessellation_key()
+    header = (struct.pack('<4sHH', 'T2LF', FontCacheVersion, len(stamp)) + stamp +
+              struct.pack('<H', len(tessellation)) + tessellation + struct.pack('<I', len(keys)))
+    bboxes = font.metrics.bboxes
+    offset = len(header) + sum([2 + len(key) + 38 for key in keys])
+    directory = []
+    for key, n, record in zip(keys, narcs, records):
+        directory.append(struct.pack('<H', len(key)) + key + struct.pack('<H4dI', *((n,) + bboxes[key] + (offset,))))
+        offset += len(record)
+
+    tmpfile = "%s.%d" % (cachefile, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(cachefile)):
+            os.makedirs(os.path.dirname(cachefile))
+        f = open(tmpfile, 'wb')
+        f.write(header + ''.join(directory) + ''.join(records))
+        f.close()
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError):
+        # a read only cache is not an error, we just parse every time
+        pass
+
+
+def load_cached_commands(data, offset):
+    # the glyph_commands() of the record at offset
+    n, = struct.unpack_from('<I', data, offset)
+    kinds = data[offset + 4:offset + 4 + n]
+    nvalues = sum([CommandSize[kind] for kind in kinds])
+    return kinds, struct.unpack_from('<%dd' % nvalues, data, offset + 4 + n)
+
+
+def load_font_cache(cachefile, stamp):
+    try:
+        f = open(cachefile, 'rb')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+    except (IOError, ValueError, mmap.error):
+        return None
+
+    try:
+        magic, version, stamplen = struct.unpack_from('<4sHH', data, 0)
+        pos = 8
+        if magic != 'T2LF' or version != FontCacheVersion or data[pos:pos + stamplen] != stamp:
+            return None
+        pos += stamplen
+        tesslen, = struct.unpack_from('<H', data, pos)
+        tessellation = data[pos + 2:pos + 2 + tesslen]
+        pos += 2 + tesslen
+        nglyphs, = struct.unpack_from('<I', data, pos)
+        pos += 4
+        index = {}
+        bboxes = {}
+        arcs = []
+        for i in range(nglyphs):
+            keylen, = struct.unpack_from('<H', data, pos)
+            key = data[pos + 2:pos + 2 + keylen]
+            pos += 2 + keylen
+            narcs, xmin, ymin, xmax, ymax, offset = struct.unpack_from('<H4dI', data, pos)
+            pos += 38
+            index[key] = offset
+            bboxes[key] = (xmin, ymin, xmax, ymax)
+            if narcs:
+                arcs.append(key)
+    except struct.error:
+        # truncated or corrupted, rebuild it
+        return None
+
+    def load_glyph(key, offset):
+        return build_glyph(key, *load_cached_commands(data, offset))
+
+    def commands(key):
+        return load_cached_commands(data, index[key])
+
+    font = Font(index, load_glyph, commands)
+    if tessellation != tessellation_key():
+        for key in arcs:
+            bboxes[key] = font.bbox(key)
+    font.metrics = FontMetrics(bboxes)
+    return font
+
+
+def load_font(filename):
+    stamp = font_cache_stamp(filename)
+    cachefile = font_cache_file(filename)
+    if not RebuildFontCache:
+        cached = load_font_cache(cachefile, stamp)
+        if cached is not None:
+            return cached
 
+    font = open_font(filename)  # glyphs are built as they are used
+    save_font_cache(font, cachefile, stamp)
     return font
 
 # =======================================================================
@@ -297,6 +1092,24 @@ def get_ymax():
 
 
 # =======================================================================
+def glyph_keys(string):
+    # the characters of string as glyph keys: the fonts are keyed in
+    # UTF-8, a multibyte character is one key. Not UTF-8, the bytes
+    try:
+        string.decode('ascii')
+        return string
+    except UnicodeError:
+        pass
+    try:
+        return [char.encode('utf-8') for char in string.decode('utf-8')]
+    except UnicodeError:
+        return string
+
+
+def char_codes(char):
+    return ' '.join(['0x%02X' % ord(c) for c in char])
+
+
 def sanitize(string):
     retval = ''
     good = ' ~!@#$%^&*_+=-{}[]|\:;"<>,./?'
@@ -308,6 +1121,17 @@ def sanitize(string):
     return retval
 
 
+# power of each line, -l when not given, and of some glyphs
+LinePower = []
+GlyphPower = {}
+
+
+def line_power(visit):
+    if visit < len(LinePower):
+        return LinePower[visit]
+    return laser_operative_pwr
+
+
 def laser_power(pwr):
     global Spindle
     Spindle = pwr*laser_range
@@ -315,29 +1139,251 @@ def laser_power(pwr):
 # =======================================================================
 
 
-def o9000(p1, p2, p3):
-    p28 = p2*p[1004]
-    p29 = p3*p[1005]
-    p30 = sqrt(p28*p28 + p29*p29)
-    p31 = atan2(p29, p28)
-    p32 = p30*cos(p31+p[1006]*Deg2Rad)
-    p33 = p30*sin(p31+p[1006]*Deg2Rad)
+def gcode_move(p1, x, y):
+    # move block, formatted by GcodeWriter
     if p1 < 0.5:
-        out = "G00 X%f Y%f" % (p32+p[1002], p33+p[1003])
+        return ('G00', x, y)
+    return ('G01', x, y, Spindle, Feed)
+
+
+# =======================================================================
+# Streaming G-code writer. The generators of the render pipeline yield
+# comment/raw strings and move tuples (code, X, Y[, I, J], S, F); the
+# writer formats the moves and writes in large buffered chunks.
+# precision: decimals of coordinates, %f as default
+# compact:   strip trailing zeros, X12.500000 -> X12.5
+# modal:     leave out motion code, S and F when they did not change;
+#            raw G-code (preamble, postamble) makes it forget the state
+#
+# Laser power for Grbl laser mode ($32=1), where G00 turns the laser
+# off by itself and M4 scales the power with the speed:
+# PowerMode    'block': S and F on every cut (as ever), 'group': on the
+#              first cut after a rapid, 'job': only when they change
+# MergeGroups  leave out rapids that go nowhere, the laser stays on
+#              from one stroke group into the next
+# =======================================================================
+WriterBuffer = 65536
+PowerMode = 'block'
+MergeGroups = 0
+MergeDistance = 1e-6
+
+
+class GcodeWriter:
+    def __init__(self, out, precision=6, compact=0, modal=0):
+        self.out = out
+        self.precision = precision
+        self.compact = compact
+        self.modal = modal
+        self.chunks = []
+        self.size = 0
+        self.bytes = 0
+        self.trace = None  # the moves formatted, kept for --preview
+        self.reset()
+
+    def reset(self):
+        self.motion = None
+        self.power = None
+        self.feed = None
+        self.position = None
+
+    def number(self, value):
+        text = "%.*f" % (self.precision, value)
+        if self.compact:
+            if '.' in text:
+                text = text.rstrip('0').rstrip('.')
+            if text == '-0':
+                text = '0'
+        return text
+
+    def format(self, block):
+        # the G-code of a move, None for a rapid left out
+        code = block[0]
+        if code == 'G00':
+            if MergeGroups and self.position is not None and \
+                    abs(block[1] - self.position[0]) < MergeDistance and abs(block[2] - self.position[1]) < MergeDistance:
+                Counts['merged'] += 1
+                return None
+            if PowerMode == 'group':
+                self.power = self.feed = None
+        self.position = (block[1], block[2])
+        Counts[code] += 1
+        if self.trace is not None:
+            self.trace.append(block)
+        words = []
+        if not (self.modal and code == self.motion):
+            words.append(code)
+        self.motion = code
+        words.append('X' + self.number(block[1]))
+        words.append('Y' + self.number(block[2]))
+        if len(block) == 7:
+            words.append('I' + self.number(block[3]))
+            words.append('J' + self.number(block[4]))
+        if code != 'G00':
+            power = "%.0f" % block[-2]
+            feed = "%.0f" % block[-1]
+            modal = self.modal or PowerMode != 'block'
+            if not (modal and power == self.power):
+                words.append('S' + power)
+            if not (modal and feed == self.feed):
+                words.append('F' + feed)
+            self.power = power
+            self.feed = feed
+        return ' '.join(words)
+
+    def emit(self, blocks):
+        Timer.begin('emit')
+        count = 0
+        try:
+            for block in blocks:
+                if isinstance(block, tuple):
+                    line = self.format(block)
+                    if line is None:
+                        continue
+                    line += '\n'
+                else:
+                    line = block + '\n'
+                    if self.modal and [l for l in block.split('\n') if l.strip() and l.strip()[0] not in ';(']:
+                        self.reset()
+                count += 1
+                self.chunks.append(line)
+                self.size += len(line)
+                if self.size >= WriterBuffer:
+                    self.flush()
+        finally:
+            Counts['blocks'] += count
+            Timer.end()
+
+    def write(self, text):
+        # G-code formatted elsewhere, its modal state is unknown
+        self.chunks.append(text)
+        self.size += len(text)
+        self.reset()
+        if self.size >= WriterBuffer:
+            self.flush()
+
+    def flush(self):
+        Timer.begin('write')
+        try:
+            self.out.write(''.join(self.chunks))
+        finally:
+            Timer.end()
+        Counts['bytes'] += self.size
+        self.bytes += self.size
+        self.chunks = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        if self.out is not sys.stdout:
+            self.out.close()
+        else:
+            self.out.flush()
+
+
+def open_output(name):
+    # -o file, or tcp:host:port to stream to a socket
+    if name.startswith('tcp:'):
+        import socket
+        host, port = name[4:].rsplit(':', 1)
+        return socket.create_connection((host, int(port))).makefile('wb')
+    return open(name, 'w')
+
+
+Output = GcodeWriter(sys.stdout)
+
+
+# =======================================================================
+# Native arcs. Arcs are only tessellated in the glyph model: the segments
+# of an arc carry its tag (see Line.arc), and when the transform keeps
+# circles circles (same X and Y scale, any rotation, mirror or flip)
+# a run of segments of the same arc is written as one G02/G03 with its
+# center as I/J. An anisotropic scaling gets the line segments.
+# =======================================================================
+def native_arcs():
+    return NativeArcs and abs(p[1004]) == abs(p[1005])
+
+
+def gcode_arc(ccw, x, y, i, j):
+    if ccw:
+        code = "G03"
     else:
-        out = "G01 X%f Y%f S%.0f F%.0f" % (p32 + p[1002], p33 + p[1003], Spindle, Feed)
+        code = "G02"
+    return (code, x, y, i, j, Spindle, Feed)
 
-    return out
 
+def machine_arcs(glyph, xy, n, m):
+    # (tag, center) in machine coordinates of the vertices of a glyph
+    # laid out at xy[n]
+    arcs = []
+    for k, arc in enumerate(glyph.arcs):
+        if arc is None:
+            arcs.append(None)
+        else:
+            tag, dx, dy = arc
+            px, py = xy[n + k - 1]
+            arcs.append((tag, px + m[0][0] * dx + m[0][1] * dy, py + m[1][0] * dx + m[1][1] * dy))
+    return arcs
+
+
+def reverse_arcs(arcs):
+    # arcs of a path cut backwards, see reverse_path()
+    return [None] + [(-arc[0], arc[1], arc[2]) if arc else None for arc in arcs[:0:-1]]
+
+
+def arc_moves(points, moves, arcs, flip):
+    # moves to points, a run of segments of the same arc as one G02/G03;
+    # flip is set when the transform turns ccw into cw
+    i = 0
+    count = len(points)
+    while i < count:
+        x, y = points[i]
+        arc = arcs[i]
+        if arc is None or moves[i] < 0.5:
+            yield gcode_move(moves[i], x, y)
+            i += 1
+            continue
+        j = i
+        while j + 1 < count and arcs[j + 1] is not None and arcs[j + 1][0] == arc[0]:
+            j += 1
+        px, py = points[i - 1]
+        if hypot(arc[1] - px, arc[2] - py) < 1e-4:
+            # no radius to speak of
+            for k in range(i, j + 1):
+                yield gcode_move(1., points[k][0], points[k][1])
+        else:
+            yield gcode_arc((arc[0] > 0) != flip, points[j][0], points[j][1], arc[1] - px, arc[2] - py)
+        i = j + 1
 
-def code(arg, visit, last):
-    global p
-    global String
 
-    String = arg
+# =======================================================================
+# Batched transform: scale, rotate and translate of p[1002]..p[1006]
+# plus Mirror/Flip folded in a single 2x3 affine matrix, applied to all
+# the stroke endpoints of a line at once, four products a point. Plain
+# Python on purpose: the vertices come and go as lists of tuples, and
+# NumPy spends most of what it saves on the products converting them,
+# and all of it beyond some 100000 points, while its import adds 60 ms
+# to every run.
+# =======================================================================
+def affine_matrix():
+    a = p[1006]*Deg2Rad
+    sx = p[1004]
+    sy = p[1005]
+    if Mirror == 1:
+        sx = -sx
+    if Flip == 1:
+        sy = -sy
+    return [[cos(a)*sx, -sin(a)*sy, p[1002]],
+            [sin(a)*sx, cos(a)*sy, p[1003]]]
+
+
+def transform(points):
+    (a, b, c), (d, e, f) = affine_matrix()
+    return [(a*x + b*y + c, d*x + e*y + f) for x, y in points]
 
-    str1 = ""
-    # erase old gcode as needed
+
+def line_header(visit):
+    # comments heading a line, sets up p[] for its transform
+    global p
     gcode = []
 
     if visit != 0:
@@ -372,65 +1418,1963 @@ def code(arg, visit, last):
         p[1006] = Angle
         gcode.append(Preamble)
 
-    laser_power(0)
+    return gcode
 
-    font_word_space = max(font[key].get_xmax() for key in font) * (WSpaceP / 100.0)
+
+# =======================================================================
+# Layout cache. The same strings come back job after job, so the laid
+# out, untransformed vertices of a line are kept, keyed by font, text
+# and spacing; only transform() and the emission are redone. Runs are
+# dropped least recently used first once their rough size passes
+# LayoutCacheSize bytes, 0 turns the cache off.
+# =======================================================================
+LayoutCacheSize = 8 * 1024 * 1024
+LayoutRuns = collections.OrderedDict()
+LayoutBytes = 0
+LayoutHits = 0
+LayoutMisses = 0
+
+
+def layout(string):
+    # lay out the line, see layout_run(). Returns chars and the machine
+    # coordinates of the vertices
+    global LayoutBytes
+    global LayoutHits
+    global LayoutMisses
+
+    key = (fontfile, string, WSpaceP, CSpaceP, fill_key())
+    run = LayoutRuns.pop(key, None)
+    if run is not None and run[0] is font:
+        LayoutRuns[key] = run
+        LayoutHits += 1
+        chars, pieces = run[1], run[2]
+    else:
+        if run is not None:
+            LayoutBytes -= run[3]  # font was reloaded
+        LayoutMisses += 1
+        Timer.begin('layout')
+        try:
+            chars, pieces = layout_run(string)
+        finally:
+            Timer.end()
+        cache_run(key, chars, pieces, string)
+
+    Counts['chars'] += len(chars)
+    Timer.begin('transform')
+    xy = transform(pieces)
+    Timer.end()
+    return chars, xy
+
+
+def cache_run(key, chars, pieces, string):
+    global LayoutBytes
+
+    # not for a font dropped from Fonts or Chains while it was in use
+    kept = Fonts
+    if ',' in fontfile:
+        kept = Chains
+    if LayoutCacheSize and kept.get((fontfile, geometry_key())) is font:
+        size = 120 * len(pieces)  # a tuple of two floats in a list
+        size += 64 * len(chars) + len(string) + 200
+        if key in LayoutRuns:
+            LayoutBytes -= LayoutRuns.pop(key)[3]
+        LayoutRuns[key] = (font, chars, pieces, size)
+        LayoutBytes += size
+        while LayoutBytes > LayoutCacheSize and LayoutRuns:
+            LayoutBytes -= LayoutRuns.popitem(last=False)[1][3]
+
+
+def layout_stats():
+    return "layout cache: %d hits, %d misses, %d runs, %d bytes" % (LayoutHits, LayoutMisses, len(LayoutRuns), LayoutBytes)
+
+
+def layout_run(string):
+    # every glyph is a precompiled run of vertices, only shifted by its
+    # xoffset; the whole line is transformed in one go.
+    # Returns chars, a (char, glyph or None, index of its first vertex)
+    # list, and the vertices in font units
+    font_word_space = font.get_metrics().max_advance * (WSpaceP / 100.0)
     font_char_space = font_word_space * (CSpaceP / 100.0)
 
     xoffset = 0  # distance along raw string in font units
 
-    # calc a plot scale so we can show about first 15 chars of string
-    # in the preview window
-    PlotScale = 15 * font['A'].get_xmax() * XScale / 150
-
-    for char in String:
+    chars = []
+    pieces = []
+    nvertices = 0
+    for char in glyph_keys(string):
         if char == ' ':
             xoffset += font_word_space
             continue
         try:
-            gcode.append(";character '%s'" % sanitize(char))
-            first_stroke = True
-            for stroke_group in font[char].stroke_list_groups:
-                first_stroke = True
-                for stroke in stroke_group.lines:
-                    x1 = stroke.xstart + xoffset
-                    y1 = stroke.ystart
-                    if Mirror == 1:
-                        x1 = -x1
-                    if Flip == 1:
-                        y1 = -y1
-                    # check and see if we need to move to a new discontinuous start point
-                    if first_stroke:
-                        first_stroke = False
-                        # lift engraver, rapid to start of stroke, drop tool
-                        laser_power(0)
-                        gcode.append(o9000(0., x1, y1))
-                        laser_power(laser_operative_pwr)
-                    x2 = stroke.xend + xoffset
-                    y2 = stroke.yend
-                    if Mirror == 1:
-                        x2 = -x2
-                    if Flip == 1:
-                        y2 = -y2
-                    gcode.append(o9000(1., x2, y2))
-
-            # move over for next character
-            char_width = font[char].get_xmax()
-            xoffset += font_char_space + char_width
-
+            glyph = font[char]
         except KeyError:
-            gcode.append("; warning: character '0x%02X' not found in font defn" % ord(char))
+            chars.append((char, None, nvertices))
+            continue
+        if glyph.vertices is None:
+            Timer.begin('compile')
+            glyph.compile()
+            Timer.end()
+            Counts['glyphs compiled'] += 1
+        if Fill:
+            Timer.begin('fill')
+            glyph = filled_glyph(glyph)
+            Timer.end()
+        chars.append((char, glyph, nvertices))
+        pieces.extend([(x + xoffset, y) for x, y in glyph.vertices])
+        nvertices += len(glyph.vertices)
+
+        # move over for next character
+        xoffset += font_char_space + glyph.advance
+
+    return chars, pieces
+
+
+def code_blocks(arg, visit, last):
+    # G-code blocks of a line, see GcodeWriter
+    global String
 
-        gcode.append("")  # blank line after every char block
+    String = arg
 
-    laser_power(0)
+    for line in line_header(visit):
+        yield line
+
+    for block in line_moves(visit):
+        yield block
 
     # finish up with icing
     if last:
-        gcode.append(Postamble)
+        yield Postamble
+
+
+def line_moves(visit):
+    # blocks of the characters of String, p[] set up by line_header()
+    laser_power(0)
+
+    chars, xy = layout(String)
+
+    native = native_arcs()
+    if native:
+        m = affine_matrix()
+        flip = m[0][0] * m[1][1] - m[0][1] * m[1][0] < 0
+
+    # lift engraver on rapids, drop tool on cuts
+    power = line_power(visit)
+    laser_power(power)
+    for char, glyph, n in chars:
+        yield ";character '%s'" % sanitize(char)
+        if GlyphPower:
+            laser_power(GlyphPower.get(char, power))
+        if glyph is None:
+            yield "; warning: character '%s' not found in font defn" % char_codes(char)
+        elif native and glyph.has_arcs:
+            for block in arc_moves(xy[n:n + len(glyph.vertices)], glyph.moves, machine_arcs(glyph, xy, n, m), flip):
+                yield block
+        else:
+            for p1 in glyph.moves:
+                yield gcode_move(p1, xy[n][0], xy[n][1])
+                n += 1
+
+        yield ""  # blank line after every char block
+
+    laser_power(0)
+
+
+def code(arg, visit, last):
+    Output.emit(code_blocks(arg, visit, last))
+    if last:
+        Output.flush()
+
+
+# =======================================================================
+# Path planner: orders the stroke groups of the whole job to cut down
+# rapid travel. A path is the vertex list of one stroke group in machine
+# coordinates; open paths may be cut backwards, closed ones are only
+# reordered. before[k] holds the paths that have to be cut before path
+# k (inner groups of the same glyph, see inside_first()).
+# Nearest neighbour over a grid of path ends, then 2-opt moves on a
+# window of the sequence, rejecting reversals that would put an outer
+# group before its inner ones. Travel starts at the origin.
+# =======================================================================
+PlanWindow = 40
+PlanPasses = 8
+
+
+def dist(a, b):
+    return hypot(a[0] - b[0], a[1] - b[1])
+
+
+def path_ends(path, rev):
+    # (entry, exit) point of a path cut forward or backwards
+    if rev:
+        return path[-1], path[0]
+    return path[0], path[-1]
+
+
+def rapid_length(paths, order, origin=(0, 0)):
+    length = 0
+    pos = origin
+    for k, rev in order:
+        entry, pos_next = path_ends(paths[k], rev)
+        length += dist(pos, entry)
+        pos = pos_next
+    return length
+
+
+def nearest_neighbour(paths, before, origin=(0, 0)):
+    n = len(paths)
+    xs = [pt[0] for path in paths for pt in (path[0], path[-1])]
+    ys = [pt[1] for path in paths for pt in (path[0], path[-1])]
+    x0, y0 = min(xs), min(ys)
+    cell = max(max(xs) - x0, max(ys) - y0) / max(1, sqrt(n)) or 1.
+    nx = int((max(xs) - x0) / cell) + 1
+    ny = int((max(ys) - y0) / cell) + 1
+
+    def cell_of(pt):
+        return (min(max(int((pt[0] - x0) / cell), 0), nx - 1),
+                min(max(int((pt[1] - y0) / cell), 0), ny - 1))
+
+    grid = {}
+    closed = []
+    for k, path in enumerate(paths):
+        closed.append(dist(path[0], path[-1]) < 0.001)
+        grid.setdefault(cell_of(path[0]), []).append((k, False))
+        if not closed[k]:
+            grid.setdefault(cell_of(path[-1]), []).append((k, True))
+
+    pending = [len(b) for b in before]
+    after = [[] for k in range(n)]
+    for k in range(n):
+        for j in before[k]:
+            after[j].append(k)
+
+    order = []
+    pos = origin
+    while len(order) < n:
+        cx, cy = cell_of(pos)
+        best = None
+        r = 0
+        # ring r holds points at least (r - 1) cells away
+        while best is None or best[0] > (r - 1) * cell:
+            if r > nx + ny:
+                break
+            for i in range(cx - r, cx + r + 1):
+                for j in range(cy - r, cy + r + 1):
+                    if max(abs(i - cx), abs(j - cy)) != r:
+                        continue
+                    for k, rev in grid.get((i, j), ()):
+                        if pending[k]:
+                            continue
+                        d = dist(pos, path_ends(paths[k], rev)[0])
+                        if best is None or d < best[0]:
+                            best = (d, k, rev)
+            r += 1
+
+        d, k, rev = best
+        order.append((k, rev))
+        pos = path_ends(paths[k], rev)[1]
+        grid[cell_of(paths[k][0])].remove((k, False))
+        if not closed[k]:
+            grid[cell_of(paths[k][-1])].remove((k, True))
+        pending[k] = -1
+        for j in after[k]:
+            pending[j] -= 1
+
+    return order, closed
+
+
+def two_opt(paths, before, order, closed, origin=(0, 0)):
+    # reversing order[i:j+1] swaps entry and exit of every path in it
+    n = len(order)
+    entry = [path_ends(paths[k], rev)[0] for k, rev in order]
+    exit = [path_ends(paths[k], rev)[1] for k, rev in order]
+    for npass in range(PlanPasses):
+        improved = False
+        for i in range(n):
+            if i == 0:
+                px, py = origin
+            else:
+                px, py = exit[i - 1]
+            ex, ey = entry[i]
+            d_in = hypot(px - ex, py - ey)
+            for j in range(i + 1, min(n, i + PlanWindow)):
+                lx, ly = exit[j]
+                old = d_in
+                new = hypot(px - lx, py - ly)
+                if j + 1 < n:
+                    nx, ny = entry[j + 1]
+                    old += hypot(lx - nx, ly - ny)
+                    new += hypot(ex - nx, ey - ny)
+                if new >= old - 1e-9:
+                    continue
+                segment = set([k for k, rev in order[i:j + 1]])
+                if [k for k in segment if segment.intersection(before[k])]:
+                    continue
+                order[i:j + 1] = [(k, rev ^ (not closed[k])) for k, rev in reversed(order[i:j + 1])]
+                entry[i:j + 1], exit[i:j + 1] = exit[j:i - n - 1:-1], entry[j:i - n - 1:-1]
+                ex, ey = entry[i]
+                d_in = hypot(px - ex, py - ey)
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def plan_paths(paths, before):
+    if not paths:
+        return []
+    order, closed = nearest_neighbour(paths, before)
+    return two_opt(paths, before, order, closed)
+
+
+# =======================================================================
+# Job time estimate, from the laid out vertices before any G-code is
+# written. Trapezoidal motion: a move speeds up at MachineAccel to its
+# feed and slows down in time for the next corner, which it may pass at
+# the speed the junction deviation of Grbl allows. Rapids start and end
+# at rest, at RapidFeed. Arcs count as their line segments, the corners
+# of which are too small to slow the machine down.
+# An estimate is a dict of seconds, cut_mm, rapid_mm and moves, the
+# number of G-code moves.
+# =======================================================================
+MachineAccel = 500.  # mm/s^2
+RapidFeed = 3000.  # mm/min
+JunctionDeviation = 0.01  # mm
+Estimate = 0  # estimate as comments heading the program
+EstimateFile = None  # and/or as JSON
+Estimates = []
+
+
+def move_time(length, v0, v1, v, accel):
+    # seconds of a move entered at v0 and left at v1, at most v
+    da = (v * v - v0 * v0) / (2 * accel)
+    dd = (v * v - v1 * v1) / (2 * accel)
+    if da + dd <= length:
+        return (v - v0) / accel + (v - v1) / accel + (length - da - dd) / v
+    peak = sqrt((2 * accel * length + v0 * v0 + v1 * v1) / 2)
+    return (peak - v0) / accel + (peak - v1) / accel
+
+
+def cut_time(points, feed):
+    # seconds and length of the cuts through points, at rest at both ends
+    v = feed / 60.
+    a = MachineAccel
+    lengths = []
+    dirs = []
+    for i in range(1, len(points)):
+        dx = points[i][0] - points[i - 1][0]
+        dy = points[i][1] - points[i - 1][1]
+        length = hypot(dx, dy)
+        if length > 1e-9:
+            lengths.append(length)
+            dirs.append((dx / length, dy / length))
+    n = len(lengths)
+    if not n:
+        return 0., 0.
+
+    # fastest entry of each move, through the corner before it
+    entry = [0.]
+    for i in range(1, n):
+        cos_theta = -(dirs[i - 1][0] * dirs[i][0] + dirs[i - 1][1] * dirs[i][1])
+        if cos_theta > 0.999999:
+            entry.append(0.)  # turning back
+        elif cos_theta < -0.999999:
+            entry.append(v)  # straight on
+        else:
+            sin_half = sqrt((1 - cos_theta) / 2)
+            entry.append(min(v, sqrt(a * JunctionDeviation * sin_half / (1 - sin_half))))
+    entry.append(0.)
+
+    # slow enough to stop for what comes, fast only as far as it can speed up
+    for i in range(n - 1, -1, -1):
+        entry[i] = min(entry[i], sqrt(entry[i + 1] * entry[i + 1] + 2 * a * lengths[i]))
+    for i in range(n):
+        entry[i + 1] = min(entry[i + 1], sqrt(entry[i] * entry[i] + 2 * a * lengths[i]))
+
+    seconds = 0.
+    for i in range(n):
+        seconds += move_time(lengths[i], entry[i], entry[i + 1], v, a)
+    return seconds, sum(lengths)
+
+
+def path_moves(points, tags):
+    # G-code moves arc_moves() makes of a path, tags the arc of each
+    # vertex, None without native arcs
+    if tags is None:
+        return len(points)
+    moves = 1
+    for i in range(1, len(tags)):
+        if tags[i] is None or tags[i] != tags[i - 1] or i == 1:
+            moves += 1
+    return moves
+
+
+def estimate_paths(paths, pos):
+    # estimate of the (points, tags) paths cut in turn from pos, None
+    # for the origin, and where it ends
+    estimate = {'seconds': 0., 'cut_mm': 0., 'rapid_mm': 0., 'moves': 0}
+    for points, tags in paths:
+        rapid = dist(pos or (0., 0.), points[0])
+        if MergeGroups and pos is not None and rapid < MergeDistance:
+            estimate['moves'] -= 1
+        elif rapid > 0:
+            estimate['seconds'] += move_time(rapid, 0., 0., RapidFeed / 60., MachineAccel)
+        seconds, cut = cut_time(points, Feed)
+        estimate['seconds'] += seconds
+        estimate['cut_mm'] += cut
+        estimate['rapid_mm'] += rapid
+        estimate['moves'] += path_moves(points, tags)
+        pos = points[-1]
+    return estimate, pos
+
+
+def estimate_line(visit, string, pos):
+    # estimate of a line as code() cuts it. Cutting a glyph takes the
+    # same time wherever it is and however it is turned, so the glyphs
+    # keep the times of their groups for the scale and machine limits
+    global String
+
+    String = string
+    line_header(visit)
+    chars, xy = layout(string)
+    native = native_arcs()
+    key = (XScale, YScale, Feed, MachineAccel, JunctionDeviation, native)
+    estimate = {'seconds': 0., 'cut_mm': 0., 'rapid_mm': 0., 'moves': 0}
+    for char, glyph, n in chars:
+        if glyph is None:
+            continue
+        bounds = glyph.starts + [len(glyph.vertices)]
+        timing = glyph.timing.get(key)
+        if timing is None:
+            tags = None
+            if native and glyph.has_arcs:
+                tags = [arc and arc[0] for arc in glyph.arcs]
+            timing = []
+            for g in range(len(glyph.starts)):
+                points = xy[n + bounds[g]:n + bounds[g + 1]]
+                seconds, cut = cut_time(points, Feed)
+                timing.append((seconds, cut, path_moves(points, tags and tags[bounds[g]:bounds[g + 1]])))
+            glyph.timing[key] = timing
+        for g in range(len(glyph.starts)):
+            start = xy[n + bounds[g]]
+            rapid = dist(pos or (0., 0.), start)
+            if MergeGroups and pos is not None and rapid < MergeDistance:
+                estimate['moves'] -= 1
+            elif rapid > 0:
+                estimate['seconds'] += move_time(rapid, 0., 0., RapidFeed / 60., MachineAccel)
+            seconds, cut, moves = timing[g]
+            estimate['seconds'] += seconds
+            estimate['cut_mm'] += cut
+            estimate['rapid_mm'] += rapid
+            estimate['moves'] += moves
+            pos = xy[n + bounds[g + 1] - 1]
+    return estimate, pos
+
+
+def estimate_job(lines):
+    pos = None  # at the origin, where the laser is off
+    job = {'seconds': 0., 'cut_mm': 0., 'rapid_mm': 0., 'moves': 0, 'lines': []}
+    for visit, item in enumerate(lines):
+        estimate, pos = estimate_line(visit, item, pos)
+        for key in estimate:
+            job[key] += estimate[key]
+        estimate['text'] = item
+        job['lines'].append(estimate)
+    return job
+
+
+def estimate_comments(job):
+    gcode = ["; estimated time %.1f s: cut %.3f mm, rapid %.3f mm, %d moves" % (
+        job['seconds'], job['cut_mm'], job['rapid_mm'], job['moves'])]
+    for visit, line in enumerate(job.get('lines', [])):
+        gcode.append(";   line %d: %.1f s, cut %.3f mm, rapid %.3f mm, %d moves" % (
+            visit, line['seconds'], line['cut_mm'], line['rapid_mm'], line['moves']))
+    return gcode
+
+
+def code_optimized(lines):
+    # the whole job in one go, stroke groups of all lines reordered by
+    # plan_paths(); comments note the character a path belongs to
+    global String
+
+    gcode = []
+    paths = []
+    path_arcs = []
+    before = []
+    labels = []
+    powers = []
+    flip = False
+    for visit, item in enumerate(lines):
+        String = item
+        gcode += line_header(visit)
+        chars, xy = layout(String)
+        native = native_arcs()
+        if native:
+            m = affine_matrix()
+            flip = m[0][0] * m[1][1] - m[0][1] * m[1][0] < 0
+        for char, glyph, n in chars:
+            if glyph is None:
+                gcode.append("; warning: character '%s' not found in font defn" % char_codes(char))
+                continue
+            if native and glyph.has_arcs:
+                arcs = machine_arcs(glyph, xy, n, m)
+            else:
+                arcs = [None] * len(glyph.vertices)
+            base = len(paths)
+            bounds = glyph.starts + [len(glyph.vertices)]
+            for g in range(len(glyph.starts)):
+                paths.append(xy[n + bounds[g]:n + bounds[g + 1]])
+                path_arcs.append(arcs[bounds[g]:bounds[g + 1]])
+                before.append(set([base + i for i in glyph.inner[g]]))
+                labels.append(";character '%s' line %d" % (sanitize(char), visit))
+                powers.append(GlyphPower.get(char, line_power(visit)))
+
+    initial = rapid_length(paths, [(k, False) for k in range(len(paths))])
+    Timer.begin('plan')
+    order = plan_paths(paths, before)
+    Timer.end()
+    optimized = rapid_length(paths, order)
+
+    if Estimate or EstimateFile:
+        ordered = []
+        for k, rev in order:
+            tags = [arc and arc[0] for arc in path_arcs[k]]
+            if rev:
+                tags = [arc and arc[0] for arc in reverse_arcs(path_arcs[k])]
+            ordered.append((rev and paths[k][::-1] or paths[k], native and tags or None))
+        job, pos = estimate_paths(ordered, None)
+        job['text'] = list(lines)
+        Estimates.append(job)
+        if Estimate:
+            gcode = estimate_comments(job) + gcode
+
+    gcode.append("")
+    label = None
+    for k, rev in order:
+        if labels[k] != label:
+            label = labels[k]
+            gcode.append(label)
+        path = paths[k]
+        arcs = path_arcs[k]
+        if rev:
+            path = path[::-1]
+            arcs = reverse_arcs(arcs)
+        # rapid to start of stroke, then cut
+        laser_power(powers[k])
+        gcode.extend(arc_moves(path, [0.] + [1.] * (len(path) - 1), arcs, flip))
+
+    laser_power(0)
+    gcode.append("")
+    gcode.append("; rapid travel %.3f, was %.3f before path optimization" % (optimized, initial))
+    gcode.append(Postamble)
+
+    Output.emit(gcode)
+    Output.flush()
+
+    return initial, optimized
+
+
+# =======================================================================
+# Jobs. A job is the lines of one plate with the current settings; the
+# fonts it uses are loaded once per process and kept in Fonts, least
+# recently used first, by file and geometry_key(): arcs and simplified
+# paths follow the scale, a job at another scale gets glyphs of its
+# own. With FontMemory set, fonts are dropped from it while their
+# Font.memory() adds up to more than FontMemory bytes, and with them the
+# chains and laid out lines that refer to them.
+# =======================================================================
+Fonts = collections.OrderedDict()
+FontMemory = 0
+FontEvictions = 0
+
+
+def font_paths():
+    fontpathlist = ["./cxf_fonts"]
+    if os.getenv("cxf_fonts"):
+        fontpathlist.append(os.getenv("cxf_fonts"))
+    if os.getenv("HOME"):
+        fontpathlist.append(os.path.join(os.getenv("HOME"), ".cxf_fonts"))
+    return fontpathlist
 
-    for line in gcode:
-        sys.stdout.write(line + '\n')
+
+def find_font(name):
+    # path of a font, of every font of a fallback chain a.cxf,b.cxf
+    if ',' in name:
+        paths = [find_font(item.strip()) for item in name.split(',')]
+        if None in paths:
+            return None
+        return ','.join(paths)
+
+    for fontpath in font_paths():
+        thefont = os.path.join(fontpath, name)
+        if os.path.exists(thefont):
+            return thefont
+    return None
+
+
+def get_font(filename):
+    global FontEvictions
+
+    if ',' in filename:
+        return get_chain(filename)
+    key = (filename, geometry_key())
+    try:
+        thefont = Fonts.pop(key)
+    except KeyError:
+        Timer.begin('font')
+        try:
+            thefont = load_font(filename)
+        finally:
+            Timer.end()
+    Fonts[key] = thefont
+
+    if FontMemory:
+        size = sum([f.memory() for f in Fonts.values()])
+        while size > FontMemory and len(Fonts) > 1:
+            key, evicted = Fonts.popitem(last=False)
+            size -= evicted.memory()
+            FontEvictions += 1
+            forget_font(key, evicted)
+    return thefont
+
+
+def forget_font(key, evicted):
+    # drop what would keep an evicted font alive: the chains it is in,
+    # whose glyphs are its own, and the lines laid out with either
+    global LayoutBytes
+
+    filename, geometry = key
+    fonts = [evicted]
+    for chain_key, chain in Chains.items():
+        if chain_key[1] == geometry and filename in chain.filenames:
+            del Chains[chain_key]
+            fonts.append(chain)
+    for run_key, run in LayoutRuns.items():
+        if [f for f in fonts if run[0] is f]:
+            del LayoutRuns[run_key]
+            LayoutBytes -= run[3]
+
+
+# =======================================================================
+# Font fallback chains. With --font a.cxf,b.cxf a character comes from
+# the first font of the chain that has it; word and character space and
+# the line height are those of the first font. Which font has which
+# glyphs is kept in a coverage index, CoverageFile in the font cache
+# directory: the glyph keys of every font file seen, stamped with its
+# mtime and size and read from the glyph headers only. A chain loads a
+# fallback font the first time one of its glyphs is needed, and then
+# only that glyph, see Font. coverage_index() indexes all the fonts of
+# the font paths for --which-fonts.
+# =======================================================================
+CoverageFile = "coverage.json"
+Coverage = None  # abspath -> [stamp, keys], keys as latin-1 for JSON
+CoverageSets = {}
+CoverageDirty = 0
+Chains = {}
+
+
+def load_coverage():
+    global Coverage
+
+    if Coverage is None:
+        try:
+            f = open(os.path.join(font_cache_dir(), CoverageFile))
+            Coverage = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            Coverage = {}
+    return Coverage
+
+
+def save_coverage():
+    global CoverageDirty
+
+    if not CoverageDirty:
+        return
+    CoverageDirty = 0
+    cachefile = os.path.join(font_cache_dir(), CoverageFile)
+    tmpfile = "%s.%d" % (cachefile, os.getpid())
+    try:
+        if not os.path.isdir(font_cache_dir()):
+            os.makedirs(font_cache_dir())
+        f = open(tmpfile, 'w')
+        json.dump(Coverage, f)
+        f.close()
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError):
+        pass
+
+
+def font_keys(filename):
+    # glyph keys of a font file, none for an unsupported version
+    f = open(filename, 'rb')
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, mmap.error):
+        data = ''
+    f.close()
+    try:
+        return index_font(data).keys()
+    except ValueError:
+        return []
+
+
+def coverage(filename):
+    # set of the glyph keys of a font file
+    global CoverageDirty
+
+    filename = os.path.abspath(filename)
+    keys = CoverageSets.get(filename)
+    if keys is not None:
+        return keys
+    index = load_coverage()
+    st = os.stat(filename)
+    stamp = "%d:%d" % (int(st.st_mtime), st.st_size)
+    entry = index.get(filename)
+    if entry is None or entry[0] != stamp:
+        Timer.begin('coverage')
+        try:
+            entry = index[filename] = [stamp, [key.decode('latin-1') for key in font_keys(filename)]]
+        finally:
+            Timer.end()
+        CoverageDirty = 1
+    keys = CoverageSets[filename] = set([key.encode('latin-1') for key in entry[1]])
+    return keys
+
+
+def coverage_index():
+    # (path, keys) of all the fonts on the font paths, search order
+    fonts = []
+    for fontpath in font_paths():
+        for filename in sorted(glob.glob(os.path.join(fontpath, "*.cxf"))):
+            fonts.append((filename, coverage(filename)))
+    save_coverage()
+    return fonts
+
+
+def fonts_covering(string):
+    # names of the fonts that have every character of string
+    keys = set(glyph_keys(string)) - set([' '])
+    names = []
+    for filename, covered in coverage_index():
+        name = os.path.basename(filename)
+        if keys <= covered and name not in names:
+            names.append(name)
+    return names
+
+
+class FallbackFont:
+    def __init__(self, filenames):
+        self.filenames = filenames
+        self.owners = {}
+        self.glyphs = {}
+        self.metrics = None
+
+    def owner(self, key):
+        # the font of the chain that has key, None if none has
+        try:
+            return self.owners[key]
+        except KeyError:
+            owner = None
+            for filename in self.filenames:
+                if key in coverage(filename):
+                    owner = filename
+                    break
+            save_coverage()
+            self.owners[key] = owner
+            return owner
+
+    def __getitem__(self, key):
+        try:
+            return self.glyphs[key]
+        except KeyError:
+            filename = self.owner(key)
+            if filename is None:
+                raise KeyError(key)
+            glyph = self.glyphs[key] = get_font(filename)[key]
+            return glyph
+
+    def __contains__(self, key):
+        return self.owner(key) is not None
+
+    def get_metrics(self):
+        if self.metrics is None:
+            self.metrics = ChainMetrics(self)
+        return self.metrics
+
+
+class ChainMetrics:
+    # FontMetrics of a chain, the boxes are looked up in the owner font
+    def __init__(self, chain):
+        first = get_font(chain.filenames[0]).get_metrics()
+        self.chain = chain
+        self.bboxes = self
+        self.max_advance = first.max_advance
+        self.ascent = first.ascent
+        self.descent = first.descent
+        self.line_height = first.line_height
+
+    def get(self, key, default=None):
+        filename = self.chain.owner(key)
+        if filename is None:
+            return default
+        return get_font(filename).get_metrics().bboxes[key]
+
+    def __getitem__(self, key):
+        box = self.get(key)
+        if box is None:
+            raise KeyError(key)
+        return box
+
+    def advance(self, key):
+        return self[key][2]
+
+
+def get_chain(filename):
+    key = (filename, geometry_key())
+    chain = Chains.get(key)
+    if chain is None:
+        chain = Chains[key] = FallbackFont(filename.split(','))
+    get_font(chain.filenames[0])
+    return chain
+
+
+def line_offset(percent):
+    # -y is a percentage of the font line height, 0 for the line height
+    font_line_height = font.get_metrics().line_height
+    if percent == 0:
+        return YScale * font_line_height
+    return YScale * font_line_height * percent / 100.
+
+
+def engrave(lines, debug, first=0, last=None):
+    # G-code of lines[first:last] of a job to Output, all of them
+    # when optimizing
+    if last is None:
+        last = len(lines)
+    if OptimizePaths:
+        initial, optimized = code_optimized(lines)
+        if debug:
+            print'rapid travel %.3f -> %.3f' % (initial, optimized)
+    else:
+        if (Estimate or EstimateFile) and first == 0:
+            job = estimate_job(lines)
+            Estimates.append(job)
+            if Estimate:
+                Output.emit(estimate_comments(job))
+        for index in range(first, last):
+            code(lines[index], index, index == (len(lines) - 1))
+
+    if ArcTolerance > 0 and last == len(lines):
+        Output.emit(["; arc tolerance %.4f mm: %d arc segments" % (ArcTolerance, arc_segment_count(lines))])
+
+
+# =======================================================================
+# Measure and fit. measure() lays out a string with the advances of
+# layout_run() from the glyph boxes of FontMetrics alone, no glyph is
+# decoded or compiled. job_bounds() puts the boxes of the lines of a job
+# on the machine for given X and Y scales: mirror, flip and angle as in
+# affine_matrix(), line origins as in line_header(). A box turned by
+# other than a right angle is larger than what it holds, so then the
+# convex hull of the laid out vertices of a line is used. With FitBox set,
+# fit_scale() finds the largest scale that keeps the job within
+# FitBox mm, by bisection over job_bounds(); FitStretch scales X and Y
+# apart to fill it. A box of 0 leaves that side free.
+# =======================================================================
+FitBox = None
+FitStretch = 0
+
+
+def measure(string):
+    # (xmin, ymin, xmax, ymax) of string in font units, None if no
+    # character of it is in the font
+    metrics = font.get_metrics()
+    bboxes = metrics.bboxes
+    font_word_space = metrics.max_advance * (WSpaceP / 100.0)
+    font_char_space = font_word_space * (CSpaceP / 100.0)
+
+    xoffset = 0
+    box = None
+    for char in glyph_keys(string):
+        if char == ' ':
+            xoffset += font_word_space
+            continue
+        bbox = bboxes.get(char)
+        if bbox is None:
+            continue
+        xmin, ymin, xmax, ymax = bbox
+        if box is None:
+            box = [xmin + xoffset, ymin, xmax + xoffset, ymax]
+        else:
+            box[0] = min(box[0], xmin + xoffset)
+            box[1] = min(box[1], ymin)
+            box[2] = max(box[2], xmax + xoffset)
+            box[3] = max(box[3], ymax)
+        xoffset += font_char_space + xmax
+    if box is None:
+        return None
+    return tuple(box)
+
+
+def convex_hull(points):
+    # Andrew's monotone chain
+    points = sorted(set(points))
+    if len(points) < 3:
+        return points
+
+    def half(points):
+        chain = []
+        for pt in points:
+            while len(chain) > 1 and (chain[-1][0] - chain[-2][0]) * (pt[1] - chain[-2][1]) - \
+                    (chain[-1][1] - chain[-2][1]) * (pt[0] - chain[-2][0]) <= 0:
+                chain.pop()
+            chain.append(pt)
+        return chain[:-1]
+
+    return half(points) + half(points[::-1])
+
+
+def line_outline(string):
+    # points in font units around string laid out
+    if Angle % 90 == 0:
+        box = measure(string)
+        if box is None:
+            return []
+        return [(box[0], box[1]), (box[2], box[1]), (box[0], box[3]), (box[2], box[3])]
+    chars, pieces = layout_run(string)
+    return convex_hull([tuple(pt) for pt in pieces])
+
+
+def job_bounds(lines, sx, sy, spacing, outlines=None):
+    # (xmin, ymin, xmax, ymax) in mm of lines at scales sx, sy, spacing
+    # being the line offset in font units; outlines keeps line_outline()
+    # of the lines from call to call
+    if outlines is None:
+        outlines = {}
+    a = Angle * Deg2Rad
+    ca = cos(a)
+    sa = sin(a)
+    if Mirror == 1:
+        sx = -sx
+    if Flip == 1:
+        sy = -sy
+    xs = []
+    ys = []
+    for visit, line in enumerate(lines):
+        if line not in outlines:
+            outlines[line] = line_outline(line)
+        x0 = XStart
+        if visit != 0 and XLineOffset and XIndentList.find(str(visit)) != -1:
+            x0 = XStart + XLineOffset
+        y0 = YStart - abs(sy) * spacing * visit
+        for u, v in outlines[line]:
+            xs.append(x0 + ca * sx * u - sa * sy * v)
+            ys.append(y0 + sa * sx * u + ca * sy * v)
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def fit_scale(lines, percent):
+    # XScale and YScale fitting lines in FitBox, percent as -y
+    global XScale
+    global YScale
+
+    width, height = FitBox
+    if not width and not height:
+        return XScale, YScale
+    spacing = font.get_metrics().line_height
+    if percent != 0:
+        spacing *= percent / 100.
+
+    outlines = {}
+
+    def fits(sx, sy):
+        box = job_bounds(lines, sx, sy, spacing, outlines)
+        if box is None:
+            return True
+        return (not width or box[2] - box[0] <= width) and (not height or box[3] - box[1] <= height)
+
+    def largest(ok):
+        hi = 1.
+        while ok(hi):
+            hi *= 2
+            if hi > 1e9:
+                return hi
+        lo = 0.
+        for i in range(60):
+            mid = (lo + hi) / 2
+            if ok(mid):
+                lo = mid
+            else:
+                hi = mid
+        return lo
+
+    XScale = YScale = largest(lambda s: fits(s, s))
+    if FitStretch and width and height:
+        # from the uniform fit, X and Y are only tied by the angle and
+        # a few rounds settle them
+        for i in range(8):
+            XScale = largest(lambda s: fits(s, YScale))
+            YScale = largest(lambda s: fits(XScale, s))
+    return XScale, YScale
+
+
+# =======================================================================
+# Parallel rendering. A task is (settings, lines, first, last): the
+# settings are a snapshot of the JobSettings globals, all those the
+# command line sets that change the program, and of the format of the
+# Output writer, so render() gives the same G-code in any process, not
+# only in one forked from this one, and in any order. With --jobs N tasks
+# go to N forked workers, which share the fonts and compiled glyphs of
+# Fonts; results come back in task order. Every task has a writer of
+# its own, with --modal S and F are repeated at the start of a task.
+# The generator works on the module globals, render() puts the task in
+# place and when done puts back what it found (see saved_globals()), so
+# rendering in this process leaves the caller's settings as they were.
+# =======================================================================
+Jobs = 0
+
+JobSettings = ['fontfile', 'XStart', 'YStart', 'XLineOffset', 'XIndentList', 'YLineOffset',
+               'XScale', 'YScale', 'SafeZ', 'Depth', 'CSpaceP', 'WSpaceP', 'Angle', 'Mirror', 'Flip',
+               'Feed', 'laser_operative_pwr', 'laser_range', 'Preamble', 'Postamble',
+               'RebuildFontCache', 'ArcSegDeg', 'ArcTolerance', 'NativeArcs', 'Simplify', 'SimplifyTolerance',
+               'OptimizePaths', 'Fill', 'FillAngle', 'PowerMode', 'MergeGroups', 'MergeDistance',
+               'LinePower', 'GlyphPower', 'Estimate', 'EstimateFile', 'MachineAccel', 'RapidFeed',
+               'JunctionDeviation']
+
+# changed while a job is rendered, besides JobSettings
+JobGlobals = ['font', 'Output', 'Spindle', 'String']
+
+
+def saved_globals():
+    # the globals a job changes, for restore_globals()
+    g = globals()
+    saved = dict((name, g[name]) for name in JobSettings + JobGlobals)
+    saved['p'] = dict(p)
+    return saved
+
+
+def restore_globals(saved):
+    saved = dict(saved)
+    p.clear()
+    p.update(saved.pop('p'))
+    globals().update(saved)
+
+
+def job_state():
+    g = globals()
+    state = dict((name, g[name]) for name in JobSettings)
+    state['writer'] = (Output.precision, Output.compact, Output.modal)
+    return state
+
+
+def compile_glyphs(lines):
+    # before forking, so the workers get the glyphs ready to use
+    for char in set(glyph_keys(''.join(lines))):
+        if char in font:
+            glyph = font[char]
+            if glyph.vertices is None:
+                glyph.compile()
+            if Fill:
+                filled_glyph(glyph)
+
+
+def render(task):
+    global font
+    global Output
+
+    state, lines, first, last = task
+    state = dict(state)
+    precision, compact, modal = state.pop('writer')
+    saved = saved_globals()
+    out = cStringIO.StringIO()
+    count = len(Estimates)
+    try:
+        globals().update(state)
+        font = get_font(fontfile)
+        if first > 0:
+            line_header(0)  # scale and angle of the job in p[]
+        Output = GcodeWriter(out, precision, compact, modal)
+        Output.trace = saved['Output'].trace
+        engrave(lines, 0, first, last)
+        Output.flush()
+        estimates = Estimates[count:]
+    finally:
+        del Estimates[count:]
+        restore_globals(saved)
+    return out.getvalue(), estimates
+
+
+def render_all(tasks):
+    # a preview traces the moves in this process
+    if Jobs < 2 or len(tasks) < 2 or Output.trace is not None:
+        for task in tasks:
+            yield render(task)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(min(Jobs, len(tasks)))
+    try:
+        for result in pool.imap(render, tasks, max(1, len(tasks) // (Jobs * 4))):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+
+
+def engrave_lines(lines, debug):
+    # one task per line, -a lines of a single job in parallel
+    if Jobs < 2 or OptimizePaths or len(lines) < 2:
+        engrave(lines, debug)
+        return
+    compile_glyphs(lines)
+    state = job_state()
+    for text, estimates in render_all([(state, lines, index, index + 1) for index in range(len(lines))]):
+        Output.write(text)
+        Estimates.extend(estimates)
+
+
+# =======================================================================
+# Step and repeat: the lines of the job cut in ArrayRows x ArrayCols
+# cells ArrayPitch mm apart, rows going down like lines. A line with a
+# {n}, {row}, {col} or {text} field (format spec allowed, {n:04d}) is
+# laid out for every cell, with n counting from ArrayFirst in reading
+# order and text the lines of --array-text; the other lines are the
+# same in every cell and are laid out and transformed once.
+# ArrayMode   'unrolled': plain G-code, the shared moves shifted into
+#             every cell; 'sub': LinuxCNC o-word subroutine, 'm98':
+#             M98/M99 subprogram after the end of the main program.
+#             A call is shifted into its cell with G92, cancelled with
+#             G92.1. Cells are cut in serpentine order.
+# =======================================================================
+ArrayRows = 0
+ArrayCols = 0
+ArrayPitch = (0., 0.)
+ArrayMode = 'unrolled'
+ArrayFirst = 1
+ArrayTexts = []
+ArraySub = 1000
+
+CellField = re.compile(r'\{(n|row|col|text)(?::([^}]*))?\}')
+
+
+def cell_text(line, n, row, col):
+    fields = {'n': n, 'row': row + 1, 'col': col + 1, 'text': ''}
+    if n - ArrayFirst < len(ArrayTexts):
+        fields['text'] = ArrayTexts[n - ArrayFirst]
+    return CellField.sub(lambda m: format(fields[m.group(1)], m.group(2) or ''), line)
+
+
+def array_cells():
+    # (n, row, col, dx, dy) in cutting order
+    for row in range(ArrayRows):
+        cols = range(ArrayCols)
+        if row % 2:
+            cols.reverse()
+        for col in cols:
+            yield ArrayFirst + row * ArrayCols + col, row, col, col * ArrayPitch[0], -row * ArrayPitch[1]
+
+
+def shifted(blocks, dx, dy):
+    for block in blocks:
+        if isinstance(block, tuple):
+            block = (block[0], block[1] + dx, block[2] + dy) + block[3:]
+        yield block
+
+
+def cell_blocks(string, visit):
+    # blocks of a line of the first cell, without the job header
+    global String
+
+    String = string
+    header = line_header(visit)
+    if visit != 0:
+        for line in header:
+            yield line
+    for block in line_moves(visit):
+        yield block
+
+
+def array_blocks(lines):
+    global String
+
+    shared = [index for index, line in enumerate(lines) if not CellField.search(line)]
+    cells = [index for index, line in enumerate(lines) if CellField.search(line)]
+
+    String = lines[0]
+    for line in line_header(0):
+        yield line
+    yield "; Array: %d x %d cells, pitch %.4f x %.4f mm" % (ArrayRows, ArrayCols, ArrayPitch[0], ArrayPitch[1])
+
+    Timer.begin('array')
+    blocks = []
+    for index in shared:
+        blocks.extend(cell_blocks(lines[index], index))
+    Timer.end()
+
+    if ArrayMode == 'sub' and shared:
+        yield "o%d sub" % ArraySub
+        for block in blocks:
+            yield block
+        yield "o%d endsub" % ArraySub
+
+    for n, row, col, dx, dy in array_cells():
+        yield "; ==================================================================="
+        yield "; Cell %d: row %d, col %d" % (n, row + 1, col + 1)
+        if ArrayMode == 'unrolled':
+            for block in shifted(blocks, dx, dy):
+                yield block
+        elif shared:
+            yield ('G00', XStart + dx, YStart + dy)
+            yield "G92 X%s Y%s" % (Output.number(XStart), Output.number(YStart))
+            if ArrayMode == 'sub':
+                yield "o%d call" % ArraySub
+            else:
+                yield "M98 P%d" % ArraySub
+            yield "G92.1"
+        for index in cells:
+            for block in shifted(cell_blocks(cell_text(lines[index], n, row, col), index), dx, dy):
+                yield block
+
+    yield Postamble
+    if ArrayMode == 'm98' and shared:
+        yield "M30"
+        yield "O%d" % ArraySub
+        for block in blocks:
+            yield block
+        yield "M99"
+
+
+def engrave_array(lines, debug):
+    if debug:
+        print'array %d x %d, %s' % (ArrayRows, ArrayCols, ArrayMode)
+    Output.emit(array_blocks(lines))
+    Output.flush()
+
+
+# =======================================================================
+# Batch mode: one job per row of a CSV manifest (header row, lines of
+# the text separated by '|') or a JSONL manifest (one object per line,
+# text a string or a list of lines). Fields left out or empty keep the
+# setting of the command line. Every job goes to its own file in the
+# --batch-dir directory, named by the output field, or else all jobs
+# make one program with a single preamble and postamble.
+# =======================================================================
+BatchFields = {
+    'font': 'fontfile',
+    'x': 'XStart',
+    'y': 'YStart',
+    'xscale': 'XScale',
+    'yscale': 'YScale',
+    'angle': 'Angle',
+    'charspace': 'CSpaceP',
+    'wordspace': 'WSpaceP',
+    'linespace': 'YLineOffset',
+    'mirror': 'Mirror',
+    'flip': 'Flip',
+    'feed': 'Feed',
+    'power': 'laser_operative_pwr',
+    'range': 'laser_range',
+}
+
+
+def read_manifest(filename):
+    import csv
+
+    f = open(filename, 'rb')
+    try:
+        if filename.lower().endswith(('.jsonl', '.json')):
+            jobs = [json.loads(line) for line in f if line.strip()]
+        else:
+            jobs = [row for row in csv.DictReader(f)]
+    except csv.Error, e:
+        raise ValueError(str(e))
+    finally:
+        f.close()
+
+    for job in jobs:
+        decode_job(job)
+    return jobs
+
+
+def decode_job(job):
+    # JSON strings to the byte strings the fonts are keyed by
+    if not isinstance(job, dict):
+        raise ValueError("job is not an object")
+    for key, value in job.items():
+        if isinstance(value, unicode):
+            job[key] = value.encode('utf-8')
+        elif isinstance(value, list):
+            job[key] = [v.encode('utf-8') if isinstance(v, unicode) else str(v) for v in value]
+    return job
+
+
+def job_settings(job):
+    # set the globals of a manifest row, returns the lines to engrave
+    g = globals()
+    for key, value in job.items():
+        if value == '' or value is None:
+            continue
+        if key == 'scale':
+            g['XScale'] = g['YScale'] = float(value)
+        elif key == 'font':
+            g['fontfile'] = value
+        elif key == 'power':
+            g['laser_operative_pwr'] = float(value) / 100.
+        elif key in BatchFields:
+            g[BatchFields[key]] = float(value)
+
+    text = job.get('text', '')
+    if isinstance(text, list):
+        return text
+    return [line for line in str(text).split('|') if line]
+
+
+def prepare_job(job):
+    # settings and font of a job, returns its lines and None, or None
+    # and why it cannot be rendered
+    global YLineOffset
+    global fontfile
+    global font
+
+    try:
+        lines = job_settings(job)
+    except (TypeError, ValueError):
+        return None, "bad settings"
+    if not lines:
+        return None, "no text"
+    thefont = find_font(fontfile)
+    if thefont is None:
+        return None, "font %s not found" % fontfile
+    fontfile = thefont
+    try:
+        font = get_font(thefont)
+    except ValueError, e:
+        return None, str(e)
+    YLineOffset = line_offset(YLineOffset)
+    return lines, None
+
+
+def batch_state():
+    # the globals a job may set, to start every job from
+    names = list(BatchFields.values()) + ['XScale', 'YScale']
+    return dict((name, globals()[name]) for name in names)
+
+
+def run_batch(jobs, outdir, debug):
+    global Preamble
+    global Postamble
+
+    base = batch_state()
+    preamble, postamble = Preamble, Postamble
+    if not outdir:
+        Postamble = ""
+
+    tasks = []
+    outputs = []
+    for number, job in enumerate(jobs):
+        globals().update(base)
+        lines, message = prepare_job(job)
+        if message:
+            print "; job %d: %s, skipped" % (number + 1, message)
+            continue
+        if Jobs > 1:
+            compile_glyphs(lines)
+        if not outdir and tasks:
+            Preamble = ""
+        if debug:
+            print'job %d: %d lines, font %s' % (number + 1, len(lines), fontfile)
+
+        tasks.append((job_state(), lines, 0, len(lines)))
+        outputs.append((number + 1, job.get('output') or "job%04d.ngc" % (number + 1)))
+
+    Preamble, Postamble = preamble, postamble
+    for (number, name), (text, estimates) in zip(outputs, render_all(tasks)):
+        for estimate in estimates:
+            estimate['job'] = number
+        Estimates.extend(estimates)
+        if outdir:
+            try:
+                f = open(os.path.join(outdir, name), 'w')
+            except IOError:
+                print "; job %d: cannot open output %s, skipped" % (number, name)
+                continue
+            f.write(text)
+            f.close()
+        else:
+            Output.emit(["; job %d" % number])
+            Output.write(text)
+
+    if not outdir and tasks:
+        Output.emit([postamble])
+    if debug:
+        print'batch: %d of %d jobs, %d fonts' % (len(tasks), len(jobs), len(Fonts))
+        print layout_stats()
+
+
+# =======================================================================
+# Render server. --serve [host:]port, or unix:path for a Unix socket,
+# keeps fonts loaded between requests. POST /render takes a JSON job
+# with the fields of a batch manifest row; it is checked and its font
+# loaded first, 400 for a job that cannot be rendered and 500 when the
+# server fails, then the G-code streams back in HTTP/1.1 chunks as it is
+# written. A failure after that ends the body without its last chunk.
+# A font must be a file in one of the font directories. GET /stats
+# returns request counts and latency percentiles. Requests are handled
+# one at a time, rendering works on the module globals. Set FontMemory
+# (--font-memory) to bound the fonts kept. The HTTP modules are only
+# imported by serve(), RenderHandler is mixed into their request
+# handler there.
+# =======================================================================
+ServeFontMemory = 256 * 1024 * 1024
+ServeLatencies = 1000  # latencies kept for the percentiles
+
+
+class ServerStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = collections.deque(maxlen=ServeLatencies)
+
+    def add(self, ok, seconds):
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        self.latency.append(seconds)
+
+    def percentile(self, fraction):
+        latency = sorted(self.latency)
+        if not latency:
+            return 0.
+        return latency[int(round(fraction * (len(latency) - 1)))] * 1000
+
+    def report(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'p50_ms': self.percentile(0.5),
+            'p90_ms': self.percentile(0.9),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': self.percentile(1.),
+            'fonts': sorted(set([name for name, key in Fonts])),
+            'font_memory': sum([f.memory() for f in Fonts.values()]),
+            'font_evictions': FontEvictions,
+            'layout_hits': LayoutHits,
+            'layout_misses': LayoutMisses,
+            'layout_bytes': LayoutBytes,
+            'run': stats_report(),
+        }
+
+
+class ClientGone(Exception):
+    pass
+
+
+class ChunkedFile:
+    # file object writing a chunked HTTP/1.1 body to out
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, data):
+        if data:
+            try:
+                self.out.write('%x\r\n%s\r\n' % (len(data), data))
+            except IOError:
+                raise ClientGone()
+
+    def close(self):
+        try:
+            self.out.write('0\r\n\r\n')
+            self.out.flush()
+        except IOError:
+            raise ClientGone()
+
+
+class RenderHandler:
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.debug:
+            print'%s %s' % (self.log_date_time_string(), format % args)
+            sys.stdout.flush()
+
+    def reply(self, code, body, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.reply(404, json.dumps({'error': 'not found'}))
+            return
+        self.reply(200, json.dumps(self.server.stats.report(), sort_keys=True))
+
+    def do_POST(self):
+        t0 = time.time()
+        lines, code, message = self.job()
+        if lines is None:
+            self.close_connection = 1
+            try:
+                self.reply(code, json.dumps({'error': message}))
+            except IOError:
+                pass  # client went away
+            ok = False
+        else:
+            ok = self.render(lines)
+        self.server.stats.add(ok, time.time() - t0)
+
+    def job(self):
+        # the lines of the requested job, its settings and font in place,
+        # or None, the status and why
+        if self.path != '/render':
+            return None, 404, 'not found'
+        try:
+            job = decode_job(json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0)))))
+        except (IOError, ValueError):
+            return None, 400, 'bad request'
+        if 'font' in job:
+            message = font_error(str(job['font']))
+            if message:
+                return None, 400, message
+        try:
+            globals().update(self.server.base)
+            lines, message = prepare_job(job)
+        except Exception, e:
+            if self.server.debug:
+                traceback.print_exc()
+            return None, 500, str(e) or e.__class__.__name__
+        if message:
+            return None, 400, message
+        return lines, 200, None
+
+    def render(self, lines):
+        # stream the G-code of lines, True when it all went out
+        global Output
+
+        writer = Output
+        out = ChunkedFile(self.wfile)
+        ok = False
+        try:
+            try:
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+            except IOError:
+                raise ClientGone()
+            Output = GcodeWriter(out, writer.precision, writer.compact, writer.modal)
+            engrave(lines, 0)
+            Output.flush()
+            out.close()
+            ok = True
+        except ClientGone:
+            pass  # client went away
+        except Exception:
+            # too late for a status, the body stays unfinished
+            if self.server.debug:
+                traceback.print_exc()
+        finally:
+            Output = writer
+        if not ok:
+            self.close_connection = 1
+        return ok
+
+
+def font_error(name):
+    # why a requested font, or chain of fonts, may not be loaded, or
+    # None when each is a regular file inside a font directory
+    for item in name.split(','):
+        item = item.strip()
+        path = find_font(item)
+        if path is None:
+            return "font %s not found" % item
+        path = os.path.realpath(path)
+        dirs = [os.path.join(os.path.realpath(d), '') for d in font_paths()]
+        if not os.path.isfile(path) or not [d for d in dirs if path.startswith(d)]:
+            return "font %s is not a font file" % item
+    return None
+
+
+def serve(address, debug):
+    global FontMemory
+
+    import BaseHTTPServer
+    import SocketServer
+
+    class Handler(RenderHandler, BaseHTTPServer.BaseHTTPRequestHandler):
+        pass
+
+    class RenderServer(BaseHTTPServer.HTTPServer):
+        allow_reuse_address = True
+
+    if not FontMemory:
+        FontMemory = ServeFontMemory
+    if address.startswith('unix:'):
+        path = address[5:]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = SocketServer.UnixStreamServer(path, Handler)
+    else:
+        path = None
+        host, port = '127.0.0.1', address
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+        server = RenderServer((host, int(port)), Handler)
+
+    server.base = batch_state()
+    server.stats = ServerStats()
+    server.debug = debug
+    if debug:
+        print'serving on %s' % (address)
+        sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    if path:
+        os.unlink(path)
+
+
+# =======================================================================
+# Engine API, for Python code that embeds the generator rather than
+# running it:
+#     renderer = text2laser.Renderer(font='romans.cxf', scale=0.5)
+#     gcode = renderer.render(['SN-0001', 'LOT 7'])
+#     renderer.render('SN-0002|LOT 7', out, feed=3000)  # streamed to out
+# A Renderer takes the fields of a manifest job (BatchFields, scale),
+# over the settings the module has when it is made, and loads its font
+# once; render() may override fields for one call. The generator works
+# on the module globals, so render() puts the settings in place every
+# time and puts back the globals it found when done, leaving the module
+# as it was for the next Renderer. With --stdin a job is read per line
+# of standard input, a JSON object as in a JSONL manifest or else just
+# the text, and its program written framed: "; job <n> <bytes>" and
+# that many bytes of G-code, or "; job <n> error <why>"; anything else
+# printed goes to stderr.
+# =======================================================================
+class Renderer:
+    def __init__(self, precision=None, compact=None, modal=None, **settings):
+        self.base = batch_state()
+        self.settings = decode_job(settings)
+        self.precision = precision
+        if precision is None:
+            self.precision = Output.precision
+        self.compact = compact
+        if compact is None:
+            self.compact = Output.compact
+        self.modal = modal
+        if modal is None:
+            self.modal = Output.modal
+        saved = saved_globals()
+        try:
+            self.setup({'text': ' '})  # the font
+        finally:
+            restore_globals(saved)
+
+    def setup(self, job):
+        # settings and font of job, a dict of manifest fields, in place;
+        # returns the lines of its text
+        settings = dict(self.settings)
+        settings.update(decode_job(dict(job)))
+        globals().update(self.base)
+        lines, message = prepare_job(settings)
+        if message:
+            raise ValueError(message)
+        return lines
+
+    def render(self, text, out=None, **settings):
+        # G-code of text, a list of lines or lines separated by '|',
+        # returned or written to the file object out
+        job = dict(settings)
+        job['text'] = text
+        return self.render_job(job, out)
+
+    def render_job(self, job, out=None):
+        # the same for job, a dict of manifest fields with its text
+        global Output
+
+        buf = out
+        if out is None:
+            buf = cStringIO.StringIO()
+        saved = saved_globals()
+        try:
+            lines = self.setup(job)
+            Output = GcodeWriter(buf, self.precision, self.compact, self.modal)
+            Output.trace = saved['Output'].trace
+            engrave(lines, 0)
+            Output.flush()
+        finally:
+            restore_globals(saved)
+        if out is None:
+            return buf.getvalue()
+
+
+def run_stdin(debug):
+    try:
+        renderer = Renderer()
+    except ValueError, e:
+        print "; %s" % e
+        sys.exit(1)
+
+    # only the frames on stdout, warnings and debug output to stderr
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        number = 0
+        for line in iter(sys.stdin.readline, ''):
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            number += 1
+            try:
+                if line.lstrip().startswith('{'):
+                    job = decode_job(json.loads(line))
+                else:
+                    job = {'text': line}
+                job.setdefault('text', '')
+                gcode = renderer.render_job(job)
+            except Exception, e:
+                why = str(e) or e.__class__.__name__
+                Output.write("; job %d error %s\n" % (number, why.replace('\n', ' ')))
+            else:
+                Output.write("; job %d %d\n" % (number, len(gcode)) + gcode)
+            Output.flush()
+            Output.out.flush()
+            if debug:
+                print'job %d done' % number
+    finally:
+        sys.stdout = stdout
+
+
+# =======================================================================
+# Preview. With --preview the writer keeps the moves it formats (see
+# GcodeWriter.trace) and they are drawn when the job is done, from the
+# origin on: cuts black, rapids red and dashed, arcs in 10 degree
+# segments. SVG is in mm; PNG is PreviewSize pixels on the longer side,
+# all segments rasterized at once with NumPy, a pixel per step along
+# the longer axis, or pixel by pixel without it. No GUI is needed.
+# =======================================================================
+PreviewSize = 1024
+PreviewMargin = 8  # pixels
+
+
+def load_numpy():
+    # NumPy if it is installed, imported the first time it is asked for
+    global numpy
+    global NumpyTried
+
+    if not NumpyTried:
+        NumpyTried = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+def preview_segments(trace):
+    # (cuts, rapids), lists of (x0, y0, x1, y1)
+    cuts = []
+    rapids = []
+    px, py = 0., 0.
+    for block in trace:
+        code, x, y = block[0], block[1], block[2]
+        if code == 'G01':
+            cuts.append((px, py, x, y))
+        elif code == 'G00':
+            rapids.append((px, py, x, y))
+        else:
+            cx = px + block[3]
+            cy = py + block[4]
+            r = hypot(block[3], block[4])
+            a0 = atan2(py - cy, px - cx)
+            a1 = atan2(y - cy, x - cx)
+            if code == 'G03' and a1 <= a0 + 1e-9:
+                a1 += 2 * pi
+            if code == 'G02' and a1 >= a0 - 1e-9:
+                a1 -= 2 * pi
+            n = int(abs(a1 - a0) / (10 * Deg2Rad)) + 1
+            for k in range(1, n):
+                a = a0 + (a1 - a0) * k / n
+                qx = cx + r * cos(a)
+                qy = cy + r * sin(a)
+                cuts.append((px, py, qx, qy))
+                px, py = qx, qy
+            cuts.append((px, py, x, y))
+        px, py = x, y
+    return cuts, rapids
+
+
+def preview_bounds(segments):
+    if not len(segments):
+        return 0., 0., 1., 1.
+    if numpy is not None:
+        s = numpy.asarray(segments)
+        return (min(s[:, 0].min(), s[:, 2].min()), min(s[:, 1].min(), s[:, 3].min()),
+                max(s[:, 0].max(), s[:, 2].max()), max(s[:, 1].max(), s[:, 3].max()))
+    xs = [s[0] for s in segments] + [s[2] for s in segments]
+    ys = [s[1] for s in segments] + [s[3] for s in segments]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def svg_path(segments):
+    # SVG y runs down
+    d = []
+    end = None
+    for x0, y0, x1, y1 in segments:
+        if (x0, y0) != end:
+            d.append("M%.3f %.3f" % (x0, 0. - y0))
+        d.append("L%.3f %.3f" % (x1, 0. - y1))
+        end = (x1, y1)
+    return ' '.join(d)
+
+
+def write_svg(f, cuts, rapids):
+    xmin, ymin, xmax, ymax = preview_bounds(cuts + rapids)
+    size = max(xmax - xmin, ymax - ymin, 1e-3)
+    pad = size / 50.
+    width = xmax - xmin + 2 * pad
+    height = ymax - ymin + 2 * pad
+    f.write('<svg xmlns="http://www.w3.org/2000/svg" width="%.3fmm" height="%.3fmm" viewBox="%.3f %.3f %.3f %.3f">\n' %
+            (width, height, xmin - pad, -ymax - pad, width, height))
+    f.write('<path fill="none" stroke="#d22" stroke-width="%.4f" stroke-dasharray="%.4f" d="%s"/>\n' %
+            (size / 1000., size / 200., svg_path(rapids)))
+    f.write('<path fill="none" stroke="#000" stroke-width="%.4f" stroke-linecap="round" d="%s"/>\n' %
+            (size / 500., svg_path(cuts)))
+    f.write('</svg>\n')
+
+
+def raster(img, segments, color, dash, box, scale, height):
+    # draw segments into img, rows of RGB pixels, a dash is on for dash
+    # pixels and off for as many, 0 for solid
+    xmin, ymin = box[0], box[1]
+    if numpy is not None:
+        if not len(segments):
+            return
+        s = segments
+        x0 = PreviewMargin + (s[:, 0] - xmin) * scale
+        y0 = height - 1 - PreviewMargin - (s[:, 1] - ymin) * scale
+        dx = (s[:, 2] - s[:, 0]) * scale
+        dy = -(s[:, 3] - s[:, 1]) * scale
+        n = numpy.ceil(numpy.maximum(abs(dx), abs(dy))).astype(int) + 1
+        index = numpy.repeat(numpy.arange(len(n)), n)
+        step = numpy.arange(n.sum()) - numpy.repeat(numpy.cumsum(n) - n, n)
+        t = step / numpy.maximum(n - 1, 1)[index].astype(float)
+        xs = numpy.rint(x0[index] + t * dx[index]).astype(int)
+        ys = numpy.rint(y0[index] + t * dy[index]).astype(int)
+        if dash:
+            on = (step // dash) % 2 == 0
+            xs = xs[on]
+            ys = ys[on]
+        img[ys, xs] = color
+        return
+
+    pixel = bytearray(color)
+    for sx0, sy0, sx1, sy1 in segments:
+        x0 = PreviewMargin + (sx0 - xmin) * scale
+        y0 = height - 1 - PreviewMargin - (sy0 - ymin) * scale
+        dx = (sx1 - sx0) * scale
+        dy = -(sy1 - sy0) * scale
+        n = int(ceil(max(abs(dx), abs(dy)))) + 1
+        for step in range(n):
+            if dash and (step // dash) % 2:
+                continue
+            t = step / float(max(n - 1, 1))
+            x = int(round(x0 + t * dx))
+            img[int(round(y0 + t * dy))][3 * x:3 * x + 3] = pixel
+
+
+def write_png(f, cuts, rapids):
+    import zlib
+
+    load_numpy()
+    if numpy is not None:
+        cuts = numpy.array(cuts, dtype=float).reshape(-1, 4)
+        rapids = numpy.array(rapids, dtype=float).reshape(-1, 4)
+        box = preview_bounds(numpy.concatenate((cuts, rapids)))
+    else:
+        box = preview_bounds(cuts + rapids)
+    size = max(box[2] - box[0], box[3] - box[1], 1e-3)
+    scale = (PreviewSize - 2 * PreviewMargin - 1) / size
+    width = int(ceil((box[2] - box[0]) * scale)) + 2 * PreviewMargin + 1
+    height = int(ceil((box[3] - box[1]) * scale)) + 2 * PreviewMargin + 1
+
+    if numpy is not None:
+        img = numpy.empty((height, width, 3), dtype=numpy.uint8)
+        img.fill(255)
+    else:
+        img = [bytearray('\xff' * (3 * width)) for y in range(height)]
+    raster(img, rapids, (220, 40, 40), 4, box, scale, height)
+    raster(img, cuts, (0, 0, 0), 0, box, scale, height)
+    if numpy is not None:
+        rows = numpy.zeros((height, 3 * width + 1), dtype=numpy.uint8)
+        rows[:, 1:] = img.reshape(height, 3 * width)
+        data = rows.tostring()
+    else:
+        data = ''.join(['\x00' + str(row) for row in img])
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    f.write('\x89PNG\r\n\x1a\n')
+    f.write(chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+    f.write(chunk('IDAT', zlib.compress(data, 1)))
+    f.write(chunk('IEND', ''))
+
+
+def write_preview(filename, trace):
+    Timer.begin('preview')
+    try:
+        cuts, rapids = preview_segments(trace)
+        try:
+            f = open(filename, 'wb')
+            if filename.lower().endswith('.png'):
+                write_png(f, cuts, rapids)
+            else:
+                write_svg(f, cuts, rapids)
+            f.close()
+        except IOError:
+            print "; cannot write preview %s" % filename
+    finally:
+        Timer.end()
+
+
+# =======================================================================
+# --stats report: wall time per stage, see StageTimer, and the counts of
+# glyphs, moves, G-code blocks and bytes written
+# =======================================================================
+def stats_report():
+    wall = time.time() - Timer.start
+    stages = dict((name, {'seconds': t, 'calls': Timer.calls[name]}) for name, t in Timer.times.items())
+    stages['other'] = {'seconds': wall - sum(Timer.times.values()), 'calls': 1}
+    report = {
+        'wall_seconds': wall,
+        'stages': stages,
+        'counts': dict(Counts),
+        'layout_hits': LayoutHits,
+        'layout_misses': LayoutMisses,
+        'peak_memory_kb': 0,
+    }
+    if resource is not None:
+        report['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return report
+
+
+def print_stats(report, out):
+    counts = report['counts']
+    out.write("; stats: wall %.3f s, peak memory %d kB\n" % (report['wall_seconds'], report['peak_memory_kb']))
+    stages = report['stages']
+    for name in sorted(stages, key=lambda name: -stages[name]['seconds']):
+        out.write(";   %-14s %9.3f ms %8d calls\n" % (name, stages[name]['seconds'] * 1000, stages[name]['calls']))
+    out.write(";   glyphs %d loaded, %d compiled, %d chars laid out, layout cache %d hits %d misses\n" % (
+        counts['glyphs loaded'], counts['glyphs compiled'], counts['chars'], report['layout_hits'], report['layout_misses']))
+    out.write(";   %d blocks: %d rapids, %d cuts, %d arcs, %d bytes written\n" % (
+        counts['blocks'], counts['G00'], counts['G01'], counts['G02'] + counts['G03'], counts['bytes']))
 
 
 ################################################################################################################
@@ -463,7 +3407,65 @@ def help_message():
        -P   Preamble g code                     
        -p   Postamble g code                    
        -a   append line to engrave
+       -o   output file, tcp:host:port streams  Defaults to stdout
+                to a socket
        --font font                              defaults "normal.cxf"
+       --font font,font,...                     fallback chain, a character comes from the
+                                                first font that has it
+       --which-fonts string                     list the fonts that have every character of
+                                                string
+       --stdin                                  a job per line of standard input, text or
+                                                JSON, each program framed, see README
+       --rebuild-font-cache                     reparse font and refresh its binary cache
+       --optimize                               reorder strokes of all lines for minimum rapid travel
+       --simplify                               join touching strokes, merge collinear segments
+       --simplify-tolerance mm                  also drop points closer than mm to the path
+       --no-arcs                                always cut arcs as line segments, G02/G03 are
+                                                only used when X and Y scale are the same
+       --arc-tolerance mm                       line segments of arcs deviate at most mm from
+                                                the arc, defaults to a segment every 20 degrees
+       --precision n                            decimals of coordinates, defaults to 6
+       --compact                                strip trailing zeros of numbers
+       --modal                                  leave out G, S and F words that did not change
+       --batch manifest                         jobs from a CSV or JSONL manifest, see README
+       --batch-dir dir                          one file per job in dir, else one program
+       --jobs n                                 render batch jobs or lines in n processes,
+                                                0 for one per CPU
+       --serve [host:]port|unix:path            render server, POST /render takes a JSON job,
+                                                GET /stats, see README
+       --font-memory MB                         bound on memory of loaded fonts, least recently
+                                                used are dropped, 256 with --serve
+       --layout-cache MB                        memory for laid out lines kept for reuse,
+                                                defaults to 8, 0 turns it off
+       --stats                                  time per stage, counts and memory on stderr
+       --stats-json file                        the same as JSON
+       --profile file                           cProfile statistics, see python -m pstats
+       --estimate                               estimated job time, cut and rapid length and
+                                                moves, per line and in all, as comments heading
+                                                the program
+       --estimate-json file                     the same as JSON
+       --accel mm/s2                            acceleration for the estimate, defaults to 500
+       --rapid-feed mm/min                      speed of G00 for the estimate, defaults to 3000
+       --junction-deviation mm                  cornering for the estimate, defaults to 0.01
+       --power-mode block|group|job             S and F words on every cut, on the first cut
+                                                of a stroke group, or only when they change;
+                                                needs Grbl laser mode, see README
+       --merge-groups                           keep the laser on from one stroke group into
+                                                the next when it starts where the last ended
+       --line-power pwr,pwr,...                 laser power per line in %, -l for the rest
+       --glyph-power chars=pwr,...              laser power in % of the characters given
+       --fill mm                                hatch closed outlines with lines mm apart
+       --fill-angle deg                         angle of the hatch lines, defaults to 0
+       --array RxC                              step and repeat the lines in R rows of C cells
+       --array-pitch DX[xDY]                    distance of the cells in mm
+       --array-mode unrolled|sub|m98            plain G-code, or the lines that are the same in
+                                                every cell as o-word or M98 subprogram
+       --array-first n                          number of the first cell for {n}, defaults to 1
+       --array-text file                        text of the cells for {text}, a line per cell
+       --fit W[xH]                              scale to the largest size that fits the lines
+                                                in W x H mm, before anything is cut
+       --fit-stretch                            with --fit, scale X and Y apart to fill the box
+       --preview file.svg|file.png              draw the cuts and rapids of the program
 
       Example
       text2laser.py -S0.4 -s0.5 -a'Line0' -a'Line1' -a'Line2' -a'Line3' -F4000 -L1000 -l20> test.ngc
@@ -502,10 +3504,49 @@ def main():
     global laser_range
     global laser_operative_pwr
     global fontfile
+    global RebuildFontCache
+    global OptimizePaths
+    global Simplify
+    global SimplifyTolerance
+    global NativeArcs
+    global ArcTolerance
+    global Output
+    global Jobs
+    global FontMemory
+    global LayoutCacheSize
+    global Estimate
+    global EstimateFile
+    global MachineAccel
+    global RapidFeed
+    global JunctionDeviation
+    global PowerMode
+    global MergeGroups
+    global LinePower
+    global GlyphPower
+    global Fill
+    global FillAngle
+    global ArrayRows
+    global ArrayCols
+    global ArrayPitch
+    global ArrayMode
+    global ArrayFirst
+    global ArrayTexts
+    global FitBox
+    global FitStretch
 
 
     try:
-        options, xarguments = getopt.getopt(sys.argv[1:], 'hd:X:x:i:Y:y:S:s:Z:D:C:W:M:F:f:P:p:L:l:a:A:',["font="])
+        options, xarguments = getopt.getopt(sys.argv[1:], 'hd:X:x:i:Y:y:S:s:Z:D:C:W:M:F:f:P:p:L:l:a:A:o:',
+                                            ["font=", "rebuild-font-cache", "optimize", "batch=", "batch-dir=", "jobs=",
+                                             "serve=", "font-memory=", "layout-cache=",
+                                             "stats", "stats-json=", "profile=",
+                                             "estimate", "estimate-json=", "accel=", "rapid-feed=",
+                                             "junction-deviation=", "power-mode=", "merge-groups",
+                                             "line-power=", "glyph-power=", "fill=", "fill-angle=",
+                                             "array=", "array-pitch=", "array-mode=", "array-first=", "array-text=",
+                                             "fit=", "fit-stretch", "preview=", "which-fonts=", "stdin",
+                                             "simplify", "simplify-tolerance=", "no-arcs", "arc-tolerance=",
+                                             "precision=", "compact", "modal"])
     except getopt.error:
         print 'Error: You tried to use an unknown option. Try `text2laser.py -h\' for more information.'
         sys.exit(0)
@@ -514,6 +3555,19 @@ def main():
         help_message()
         sys.exit(0)
 
+    outfile = None
+    preview = None
+    which = None
+    stdin = 0
+    batch = None
+    address = None
+    profile = None
+    stats = 0
+    statsfile = None
+    batchdir = None
+    precision = 6
+    compact = 0
+    modal = 0
     for o, a in options:
         if o == '-h':
             help_message()
@@ -528,6 +3582,143 @@ def main():
             if debug:
                 print'font = %s' % (fontfile)
 
+        if o == "--rebuild-font-cache":
+            RebuildFontCache = 1
+
+        if o == "--optimize":
+            OptimizePaths = 1
+
+        if o == '-o' and a != '':
+            outfile = a
+        if o == "--batch" and a != '':
+            batch = a
+        if o == "--batch-dir" and a != '':
+            batchdir = a
+        if o == "--serve" and a != '':
+            address = a
+        if o == "--font-memory" and a != '':
+            FontMemory = int(float(a) * 1024 * 1024)
+        if o == "--estimate":
+            Estimate = 1
+        if o == "--estimate-json" and a != '':
+            EstimateFile = a
+        if o == "--accel" and a != '':
+            MachineAccel = float(a)
+        if o == "--rapid-feed" and a != '':
+            RapidFeed = float(a)
+        if o == "--junction-deviation" and a != '':
+            JunctionDeviation = float(a)
+
+        if o == "--power-mode" and a != '':
+            if a not in ('block', 'group', 'job'):
+                print "; power mode is block, group or job"
+                sys.exit(1)
+            PowerMode = a
+        if o == "--merge-groups":
+            MergeGroups = 1
+        if o == "--line-power" and a != '':
+            LinePower = [float(pwr) / 100. for pwr in a.split(',')]
+            if debug:
+                print'line power = %s' % (a)
+        if o == "--glyph-power" and a != '':
+            for item in a.split(','):
+                chars, pwr = item.rsplit('=', 1)
+                for char in glyph_keys(chars):
+                    GlyphPower[char] = float(pwr) / 100.
+            if debug:
+                print'glyph power = %s' % (a)
+
+        if o == "--fill" and a != '':
+            Fill = float(a)
+            if Fill <= 0:
+                print "; fill is the hatch pitch in mm, more than 0"
+                sys.exit(1)
+            if debug:
+                print'fill = %.4f' % (Fill)
+        if o == "--fill-angle" and a != '':
+            FillAngle = float(a)
+            if debug:
+                print'fill angle = %.4f' % (FillAngle)
+
+        if o == "--array" and a != '':
+            try:
+                ArrayRows, ArrayCols = [int(v) for v in a.lower().split('x')]
+            except ValueError:
+                print "; array is rows x cols, e.g. 10x5"
+                sys.exit(1)
+        if o == "--array-pitch" and a != '':
+            ArrayPitch = tuple([float(v) for v in a.lower().split('x')] * 2)[:2]
+            if debug:
+                print'array pitch = %.4f x %.4f' % ArrayPitch
+        if o == "--array-mode" and a != '':
+            if a not in ('unrolled', 'sub', 'm98'):
+                print "; array mode is unrolled, sub or m98"
+                sys.exit(1)
+            ArrayMode = a
+        if o == "--array-first" and a != '':
+            ArrayFirst = int(a)
+        if o == "--array-text" and a != '':
+            try:
+                f = open(a)
+                ArrayTexts = [line.rstrip('\r\n') for line in f]
+                f.close()
+            except IOError:
+                print "; cannot read array text %s" % a
+                sys.exit(1)
+
+        if o == "--fit" and a != '':
+            try:
+                FitBox = tuple([float(v) for v in a.lower().split('x')] + [0.])[:2]
+            except ValueError:
+                print "; fit is width x height in mm, e.g. 80x20"
+                sys.exit(1)
+        if o == "--fit-stretch":
+            FitStretch = 1
+
+        if o == "--preview" and a != '':
+            preview = a
+        if o == "--which-fonts" and a != '':
+            which = a
+        if o == "--stdin":
+            stdin = 1
+
+        if o == "--stats":
+            stats = 1
+        if o == "--stats-json" and a != '':
+            statsfile = a
+        if o == "--profile" and a != '':
+            profile = a
+        if o == "--layout-cache" and a != '':
+            LayoutCacheSize = int(float(a) * 1024 * 1024)
+        if o == "--jobs" and a != '':
+            Jobs = int(a)
+            if Jobs < 1:
+                import multiprocessing
+                Jobs = multiprocessing.cpu_count()
+            if debug:
+                print'jobs = %d' % (Jobs)
+        if o == "--precision" and a != '':
+            precision = int(a)
+        if o == "--compact":
+            compact = 1
+        if o == "--modal":
+            modal = 1
+
+        if o == "--no-arcs":
+            NativeArcs = 0
+        if o == "--arc-tolerance" and a != '':
+            ArcTolerance = float(a)
+            if debug:
+                print'arc tolerance = %.4f' % (ArcTolerance)
+
+        if o == "--simplify":
+            Simplify = 1
+        if o == "--simplify-tolerance" and a != '':
+            Simplify = 1
+            SimplifyTolerance = float(a)
+            if debug:
+                print'simplify tolerance = %.4f' % (SimplifyTolerance)
+
         if o == '-L' and a != '':
             laser_range = float(a)
             if debug:
@@ -610,40 +3801,100 @@ def main():
             if debug:
                 print'0 = %s' % (a)
 
-    import os
-
-    thefont = None
-    fontpathlist = ["./cxf_fonts"]
-    if os.getenv("cxf_fonts"):
-        fontpathlist.append(os.getenv("cxf_fonts"))
-    if os.getenv("HOME"):
-        fontpathlist.append(os.path.join(os.getenv("HOME"), ".cxf_fonts"))
+    out = sys.stdout
+    if outfile:
+        try:
+            out = open_output(outfile)
+        except (IOError, OSError, ValueError):
+            print "; cannot open output %s" % outfile
+            sys.exit(1)
+    Output = GcodeWriter(out, precision, compact, modal)
+    if preview:
+        Output.trace = []
+
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run(address, batch, batchdir, debug, which, stdin)
+        if preview:
+            write_preview(preview, Output.trace)
+    finally:
+        if profile:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        if stats:
+            print_stats(stats_report(), sys.stderr)
+        if statsfile:
+            f = open(statsfile, 'w')
+            json.dump(stats_report(), f, indent=1, sort_keys=True)
+            f.close()
+        if EstimateFile:
+            f = open(EstimateFile, 'w')
+            json.dump(Estimates, f, indent=1, sort_keys=True)
+            f.close()
+
+
+def run(address, batch, batchdir, debug, which=None, stdin=0):
+    global YLineOffset
+    global fontfile
+    global font
 
-    font_exists = False
-    for fontpath in fontpathlist:
-        thefont = os.path.join(fontpath, fontfile)
-        if os.path.exists(thefont):
-            fontfile = thefont
-            font_exists=True
-            break
+    if which:
+        for name in fonts_covering(which):
+            print name
+        return
 
-    if not font_exists:
+    if address:
+        try:
+            serve(address, debug)
+        except (IOError, OSError, ValueError):
+            print "; cannot serve on %s" % address
+            sys.exit(1)
+        return
+
+    if stdin:
+        run_stdin(debug)
+        Output.close()
+        return
+
+    if batch:
+        try:
+            jobs = read_manifest(batch)
+        except (IOError, ValueError):
+            print "; cannot read manifest %s" % batch
+            sys.exit(1)
+        run_batch(jobs, batchdir, debug)
+        Output.close()
+        return
+
+    thefont = find_font(fontfile)
+    if thefont is None:
         print "; font not found"
         sys.exit(1)
+    fontfile = thefont
 
-    file = open(fontfile)
-    font = parse(file)  # build stroke lists from font file
-    file.close()
-    font_line_height = max(font[key].get_ymax() for key in font)
-
-    if YLineOffset == 0:
-        YLineOffset = YScale*font_line_height
+    try:
+        font = get_font(fontfile)
+    except ValueError, e:
+        print "; %s" % e
+        sys.exit(1)
+    if FitBox:
+        fit_scale(stringlist, YLineOffset)
+        if debug:
+            print'fit scale = %.6f x %.6f' % (XScale, YScale)
+        # arcs and simplified paths of the fitted scale
+        font = get_font(fontfile)
+    YLineOffset = line_offset(YLineOffset)
+
+    if ArrayRows and ArrayCols and stringlist:
+        engrave_array(stringlist, debug)
     else:
-        YLineOffset = YScale * font_line_height * YLineOffset/100.
-
-
-    for index, item in enumerate(stringlist):
-        code(item, index, index == (len(stringlist) - 1))
+        engrave_lines(stringlist, debug)
+    Output.close()
+    if debug:
+        print layout_stats()
 
 
 # ===============================================================================================